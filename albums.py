@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from collections import OrderedDict
+import state
+import utils
+
+logger = logging.getLogger('tg_downloader')
+
+# Telegram albums hold at most this many messages
+ALBUM_MAX_ITEMS = 10
+# Seconds without a new member after which a buffered live album is considered complete
+ALBUM_WAIT = 0.5
+# Upper bound on remembered album captions
+CAPTION_CACHE_MAX_ITEMS = 5000
+
+_captions = OrderedDict()  # (chat id, grouped_id) -> caption, least recently used first
+_lookups = {}  # (chat id, grouped_id) -> in-flight caption fetch
+_buffers = {}  # grouped_id -> live album members received so far
+_flush_tasks = {}  # grouped_id -> task that hands the album on once it stops growing
+metrics = {'albums': 0, 'hits': 0, 'misses': 0, 'api_calls': 0}
+
+def album_stats():
+    """Caption cache counters plus Telegram requests per album."""
+    albums = metrics['albums']
+    return {**metrics, 'cached': len(_captions), 'calls_per_album': metrics['api_calls'] / albums if albums else 0}
+
+def _store(key, caption):
+    if key not in _captions:
+        metrics['albums'] += 1
+        if len(_captions) >= CAPTION_CACHE_MAX_ITEMS:
+            _captions.popitem(last=False)
+    _captions[key] = caption
+    _captions.move_to_end(key)
+
+def remember(chat_id, messages, complete=False):
+    """Take album captions from messages already at hand.
+
+    With `complete`, the albums in `messages` are whole, so one without any text has no caption;
+    otherwise only captions actually seen are remembered.
+    """
+    seen = {}
+    for message in messages:
+        if message.grouped_id:
+            seen[message.grouped_id] = seen.get(message.grouped_id) or message.text or ''
+    for grouped_id, group_caption in seen.items():
+        if group_caption or complete:
+            _store((chat_id, grouped_id), group_caption)
+
+def remember_page(chat_id, page):
+    """remember() for a contiguous history page; albums cut by either edge may continue beyond it."""
+    if not page:
+        return
+    edges = {page[0].grouped_id, page[-1].grouped_id}
+    remember(chat_id, [m for m in page if m.grouped_id not in edges], complete=True)
+    remember(chat_id, [m for m in page if m.grouped_id in edges])
+
+async def caption(message, entity):
+    """Caption of the album a message belongs to, resolved once per grouped_id."""
+    key = (entity.id, message.grouped_id)
+    if key in _captions:
+        metrics['hits'] += 1
+        _captions.move_to_end(key)
+        return _captions[key]
+    metrics['misses'] += 1
+    lookup = _lookups.get(key)
+    if lookup is None:
+        lookup = _lookups[key] = asyncio.ensure_future(_fetch_caption(message, entity))
+        lookup.add_done_callback(lambda _: _lookups.pop(key, None))
+    return await lookup
+
+async def _fetch_caption(message, entity):
+    # Album members have consecutive ids, so one request for the neighbours covers the whole album
+    ids = list(range(message.id - ALBUM_MAX_ITEMS + 1, message.id + ALBUM_MAX_ITEMS))
+    group_caption = ''
+    try:
+        metrics['api_calls'] += 1
+        for msg in await state.client.get_messages(entity, ids=ids):
+            if msg is not None and msg.grouped_id == message.grouped_id and msg.text:
+                group_caption = msg.text
+                break
+        # Cache the result (even if empty) to avoid fetching again
+        _store((entity.id, message.grouped_id), group_caption)
+    except Exception as e:
+        logger.error(f"Error getting group caption: {e}")
+    return group_caption
+
+def collect(message, on_complete):
+    """Buffer a live album member; `on_complete(messages)` runs once the album stops growing."""
+    members = _buffers.setdefault(message.grouped_id, [])
+    members.append(message)
+    task = _flush_tasks.pop(message.grouped_id, None)
+    if task:
+        task.cancel()
+    _flush_tasks[message.grouped_id] = asyncio.create_task(
+        _flush(message.grouped_id, on_complete, 0 if len(members) >= ALBUM_MAX_ITEMS else ALBUM_WAIT)
+    )
+
+async def _flush(grouped_id, on_complete, wait):
+    await asyncio.sleep(wait)
+    _flush_tasks.pop(grouped_id, None)
+    members = sorted(_buffers.pop(grouped_id, []), key=lambda m: m.id)
+    if not members:
+        return
+    remember(utils.bare_chat_id(members[0].chat_id), members, complete=True)
+    try:
+        await on_complete(members)
+    except Exception as e:
+        logger.error(f'Error handling album {grouped_id}: {e}')
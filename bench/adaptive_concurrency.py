@@ -0,0 +1,87 @@
+"""Simulation of the AIMD download concurrency controller against a throttling fake client.
+
+The fake client answers FloodWait to a share of requests once more than HIDDEN_LIMIT
+downloads run at the same time; the controller should settle around that limit.
+
+Usage: python bench/adaptive_concurrency.py [hidden_limit]   (default: 6)
+"""
+import os
+import sys
+import random
+import time
+import asyncio
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import state
+import concurrency
+
+MAX_WORKERS = 20
+STEP_INTERVAL = 0.25
+STEPS = 80
+CHUNK = 512 * 1024
+
+class ThrottlingClient:
+    """Serves chunks at a fixed per-request latency; over the hidden limit some requests get a FloodWait."""
+
+    def __init__(self, hidden_limit):
+        self.hidden_limit = hidden_limit
+        self.in_flight = 0
+
+    async def download(self, key, chunks=5):
+        self.in_flight += 1
+        try:
+            for k in range(chunks):
+                if self.in_flight > self.hidden_limit and random.random() < 0.3:
+                    state.flood_waits += 1
+                    await asyncio.sleep(0.05)
+                    return False
+                await asyncio.sleep(0.01)
+                state.update_active_download(key, (k + 1) * CHUNK)
+            return True
+        finally:
+            self.in_flight -= 1
+
+async def worker(n, limiter, client):
+    while True:
+        await limiter.acquire()
+        try:
+            state.queue.get_nowait()
+            key = f'w{n}'
+            state.active_downloads[key] = {
+                'start_time': time.time(), 'downloaded': 0, 'last_progress': time.time(), 'rate': 0, 'samples': deque()
+            }
+            try:
+                if not await client.download(key):
+                    state.queue.put_nowait(key)
+            finally:
+                del state.active_downloads[key]
+        finally:
+            limiter.release()
+
+async def main():
+    hidden_limit = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+    config.MIN_NUM, config.MAX_NUM, config.ADAPTIVE_CONCURRENCY = 1, MAX_WORKERS, True
+    state.queue = asyncio.Queue()
+    for i in range(1000000):
+        state.queue.put_nowait(i)
+    limiter = state.download_limiter = concurrency.create_limiter()
+    controller = concurrency.AimdController(limiter)
+    client = ThrottlingClient(hidden_limit)
+    workers = [asyncio.create_task(worker(n, limiter, client)) for n in range(MAX_WORKERS)]
+    history = []
+    for _ in range(STEPS):
+        await asyncio.sleep(STEP_INTERVAL)
+        controller.step()
+        history.append(limiter.limit)
+    for task in workers:
+        task.cancel()
+    settled = history[STEPS // 2:]
+    print('limit per step:', ' '.join(map(str, history)))
+    print(f'hidden limit {hidden_limit}: settled mean {sum(settled) / len(settled):.1f}, '
+          f'range {min(settled)}-{max(settled)}, {state.flood_waits} FloodWaits')
+
+if __name__ == '__main__':
+    asyncio.run(main())
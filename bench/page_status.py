@@ -0,0 +1,61 @@
+"""Per-message vs per-page status lookups on a channel with 50k tracked entries.
+
+Usage: python bench/page_status.py [backend ...]   (default: sqlite json)
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TRACKED = 50000
+PAGE_SIZE = 100
+CHANNEL_ID = 1
+
+def run(backend_name):
+    import config
+    import storage
+    directory = tempfile.mkdtemp(prefix='tgd-bench-')
+    config.PROGRESS_DIR = directory
+    config.PROGRESS_DB_FILE = os.path.join(directory, 'progress.db')
+    config.PROGRESS_BACKEND = backend_name
+    try:
+        storage.init_progress_dir()
+        # 30k completed, 15k in flight, 5k failed for good
+        storage.record_files_started(CHANNEL_ID, 'bench', list(range(1, TRACKED + 1)))
+        storage.record_scanned(CHANNEL_ID, 0, TRACKED)
+        for message_id in range(1, TRACKED * 3 // 5 + 1):
+            storage.record_file_complete(CHANNEL_ID, message_id, 'completed', file_size=1)
+        for message_id in range(TRACKED * 9 // 10 + 1, TRACKED + 1):
+            for _ in range(config.MAX_RETRIES):
+                storage.record_file_complete(CHANNEL_ID, message_id, 'failed', 'bench')
+        storage.flush_progress()
+        storage._started.clear()
+        # History pages spanning tracked and untracked ids
+        ids = list(range(1, TRACKED * 6 // 5 + 1, 7))
+
+        started = time.perf_counter()
+        single = {message_id: storage.get_file_status(CHANNEL_ID, message_id) for message_id in ids}
+        per_message = (time.perf_counter() - started) / len(ids)
+
+        started = time.perf_counter()
+        paged = {}
+        for i in range(0, len(ids), PAGE_SIZE):
+            paged.update(storage.get_file_statuses(CHANNEL_ID, ids[i:i + PAGE_SIZE]))
+        per_page = (time.perf_counter() - started) / len(ids)
+
+        assert single == paged, 'per-page statuses differ from per-message ones'
+        print(f'{backend_name:6s} per-message {per_message * 1e6:6.1f} us/msg  per-page {per_page * 1e6:6.1f} us/msg  '
+              f'({per_message / per_page:.1f}x)')
+    finally:
+        storage.close_progress()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    for backend_name in sys.argv[1:] or ['sqlite', 'json']:
+        run(backend_name)
+
+if __name__ == '__main__':
+    main()
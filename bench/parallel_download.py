@@ -0,0 +1,67 @@
+"""Throughput of large-file downloads as the number of parallel part streams grows.
+
+A fake file server serves one document from memory, with each connection limited to
+STREAM_MBPS, like a single Telegram download connection.
+
+Usage: python bench/parallel_download.py [size_mb]   (default: 64)
+"""
+import os
+import sys
+import time
+import asyncio
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import transfer
+
+# Per-connection bandwidth of the fake server
+STREAM_MBPS = 20
+
+class FakeFileServer:
+    """Stand-in client whose iter_download serves byte ranges of an in-memory file."""
+
+    def __init__(self, data):
+        self.data = data
+
+    async def iter_download(self, media, offset=0, limit=None, request_size=transfer.REQUEST_SIZE, file_size=None):
+        pos, served = offset, 0
+        while pos < len(self.data) and (limit is None or served < limit):
+            chunk = self.data[pos:pos + request_size]
+            await asyncio.sleep(len(chunk) / (STREAM_MBPS * 1024 * 1024))
+            yield chunk
+            pos += len(chunk)
+            served += 1
+
+class FakeMessage:
+    def __init__(self):
+        self.document = object()
+        self.media = object()
+
+async def main():
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 64 * 1024 * 1024
+    data = os.urandom(size)
+    server = FakeFileServer(data)
+    directory = tempfile.mkdtemp(prefix='tgd-bench-')
+    config.PARALLEL_DOWNLOAD_THRESHOLD_MB = 0
+    try:
+        baseline = None
+        for parts in (1, 2, 4, 8, 16):
+            config.PARALLEL_DOWNLOAD_PARTS = parts
+            path = os.path.join(directory, f'file{parts}')
+            started = time.perf_counter()
+            used = await transfer.download_message(server, FakeMessage(), path, size)
+            elapsed = time.perf_counter() - started
+            with open(path, 'rb') as f:
+                assert f.read() == data, 'downloaded file differs'
+            os.remove(path)
+            rate = size / elapsed / 1024 / 1024
+            baseline = baseline or rate
+            print(f'{used:2d} parts  {rate:7.1f} MB/s  {rate / baseline:4.1f}x')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    asyncio.run(main())
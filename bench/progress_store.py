@@ -0,0 +1,58 @@
+"""Per-message progress lookup and update cost for each backend at growing channel sizes.
+
+Usage: python bench/progress_store.py [rows ...]   (default: 10000 100000 1000000)
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SAMPLES = 2000
+CHANNEL_ID = 1
+
+def run(backend_name, rows):
+    import config
+    import storage
+    directory = tempfile.mkdtemp(prefix='tgd-bench-')
+    config.PROGRESS_DIR = directory
+    config.PROGRESS_DB_FILE = os.path.join(directory, 'progress.db')
+    config.PROGRESS_BACKEND = backend_name
+    try:
+        storage.init_progress_dir()
+        # Tracked rows: the channel's in-flight messages
+        for start in range(1, rows + 1, 10000):
+            storage.record_files_started(CHANNEL_ID, 'bench', list(range(start, min(start + 10000, rows + 1))))
+        storage.flush_progress()
+        storage._started.clear()
+        # JSON updates cost O(rows) each, so large JSON runs take fewer samples
+        samples = SAMPLES if backend_name == 'sqlite' else max(20, SAMPLES * 10000 // rows)
+        ids = random.sample(range(1, rows + 1), samples)
+
+        started = time.perf_counter()
+        for message_id in ids:
+            storage.get_file_status(CHANNEL_ID, message_id)
+        lookup = (time.perf_counter() - started) / samples
+
+        started = time.perf_counter()
+        for message_id in ids:
+            storage.record_file_start(CHANNEL_ID, 'bench', rows + message_id)
+            storage.record_file_complete(CHANNEL_ID, message_id, 'completed', file_size=1)
+        storage.flush_progress()
+        update = (time.perf_counter() - started) / samples
+        print(f'{backend_name:6s} {rows:>9d} rows  lookup {lookup * 1e6:8.1f} us/msg  start+complete {update * 1e6:8.1f} us/msg')
+    finally:
+        storage.close_progress()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    for rows in sizes:
+        for backend_name in ('sqlite', 'json'):
+            run(backend_name, rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Stream-to-remote vs download-then-upload: wall time and local disk writes.
+
+Uploads go to a local rclone remote through per-file rclone processes. OPERATE is
+set to copy so every byte crosses into the remote as it would on a real backend
+instead of a same-filesystem rename. Local writes come from write_bytes in
+/proc/self/io, which includes reaped rclone processes, minus the bytes the remote
+received: what is left was written by the download itself.
+
+Usage: python bench/stream_upload.py [directory]   (default: a temporary directory; needs rclone on PATH)
+"""
+import os
+import sys
+import time
+import asyncio
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import transfer
+import uploader
+
+# Telegram hands out file parts in chunks of this size
+CHUNK = 128 * 1024
+
+class MemoryClient:
+    """Stand-in client serving a document from memory as fast as it is consumed."""
+
+    def __init__(self, data):
+        self.data = data
+
+    async def iter_download(self, media, offset=0, limit=None, request_size=transfer.REQUEST_SIZE, file_size=None):
+        for pos in range(offset, len(self.data), CHUNK):
+            await asyncio.sleep(0)
+            yield self.data[pos:pos + CHUNK]
+
+class FakeMessage:
+    def __init__(self):
+        self.document = object()
+        self.media = object()
+
+def written_bytes():
+    """Bytes this process and its reaped children sent to storage, or None where /proc/self/io is missing."""
+    try:
+        with open('/proc/self/io') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('write_bytes'))
+    except (OSError, StopIteration):
+        return None
+
+async def download_then_upload(client, local_dir, remote_dir, name, size):
+    path = os.path.join(local_dir, name)
+    await transfer.download_message(client, FakeMessage(), path, size)
+    await uploader.upload_file(path, remote_dir)
+
+async def stream(client, local_dir, remote_dir, name, size):
+    await transfer.stream_message(client, FakeMessage(), remote_dir, name, size)
+
+async def run(directory, files, size, mode):
+    local_dir = os.path.join(directory, 'local')
+    remote_dir = os.path.join(directory, 'remote')
+    for path in (local_dir, remote_dir):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+    client = MemoryClient(os.urandom(size))
+    os.sync()
+    before = written_bytes()
+    started = time.perf_counter()
+    await asyncio.gather(*(mode(client, local_dir, remote_dir, f'f{i}.bin', size) for i in range(files)))
+    elapsed = time.perf_counter() - started
+    os.sync()
+    after = written_bytes()
+    for i in range(files):
+        assert os.path.getsize(os.path.join(remote_dir, f'f{i}.bin')) == size, 'remote copy has the wrong size'
+    return elapsed, None if before is None else (after - before - files * size) / 1024 / 1024
+
+async def main():
+    directory = tempfile.mkdtemp(prefix='tgd-bench-', dir=sys.argv[1] if len(sys.argv) > 1 else None)
+    config.OPERATE = 'copy'
+    config.PARALLEL_DOWNLOAD_PARTS = 1
+    uploader._semaphore = asyncio.Semaphore(max(1, config.UPLOAD_CONCURRENCY))
+    try:
+        for files, size_mb in ((1, 256), (4, 64), (16, 16)):
+            results = []
+            for label, mode in (('download+upload', download_then_upload), ('stream', stream)):
+                elapsed, written = await run(directory, files, size_mb * 1024 * 1024, mode)
+                written = 'n/a' if written is None else f'{written:5.0f} MB'
+                results.append(f'{label} {elapsed:5.2f}s {written} written')
+            print(f'{files:2d} files x {size_mb:3d} MB  ' + '  '.join(results))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+"""Local write throughput of downloads for 1, 10 and 50 concurrent writers.
+
+Compares unbuffered per-chunk writes into a sparse file (DOWNLOAD_BUFFER_KB=0,
+DOWNLOAD_PREALLOCATE=false) with the preallocated, buffered sink.
+
+Usage: python bench/write_throughput.py [directory]   (default: a temporary directory)
+"""
+import os
+import sys
+import time
+import asyncio
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import transfer
+
+# Telegram hands out file parts in chunks of this size
+CHUNK = 128 * 1024
+MODES = {
+    'per-chunk': {'DOWNLOAD_BUFFER_KB': 0, 'DOWNLOAD_PREALLOCATE': False},
+    'sink': {'DOWNLOAD_BUFFER_KB': 1024, 'DOWNLOAD_PREALLOCATE': True},
+}
+
+class MemoryClient:
+    """Stand-in client serving a document from memory as fast as it is consumed."""
+
+    def __init__(self, data):
+        self.data = data
+
+    async def iter_download(self, media, offset=0, limit=None, request_size=transfer.REQUEST_SIZE, file_size=None):
+        for pos in range(offset, len(self.data), CHUNK):
+            await asyncio.sleep(0)
+            yield self.data[pos:pos + CHUNK]
+
+class FakeMessage:
+    def __init__(self):
+        self.document = object()
+        self.media = object()
+
+async def run(directory, writers, size, mode):
+    for name, value in MODES[mode].items():
+        setattr(config, name, value)
+    client = MemoryClient(os.urandom(size))
+    paths = [os.path.join(directory, f'w{i}.bin') for i in range(writers)]
+    started = time.perf_counter()
+    await asyncio.gather(*(transfer.download_message(client, FakeMessage(), path, size) for path in paths))
+    elapsed = time.perf_counter() - started
+    for path in paths:
+        os.remove(path)
+    return writers * size / elapsed / 1024 / 1024
+
+async def main():
+    directory = tempfile.mkdtemp(prefix='tgd-bench-', dir=sys.argv[1] if len(sys.argv) > 1 else None)
+    config.PARALLEL_DOWNLOAD_PARTS = 1
+    try:
+        for writers, size_mb in ((1, 256), (10, 64), (50, 16)):
+            rates = {mode: await run(directory, writers, size_mb * 1024 * 1024, mode) for mode in MODES}
+            print(f'{writers:2d} writers x {size_mb:3d} MB  ' + '  '.join(f'{mode} {rate:7.0f} MB/s' for mode, rate in rates.items()))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,43 +1,89 @@
 import re
+import time
 import logging
+from collections import deque
 from telethon import TelegramClient, events
 import config
 import state
 import storage
 import utils
 import downloader
+import transfer
+import uploader
+import governor
+import messages
+import albums
+import scanner
+import retries
+import dedup
+import diskspace
 
 logger = logging.getLogger('tg_downloader')
 
+live_metrics = {'events': 0, 'media': 0, 'queued': 0}
+live_latency = deque(maxlen=1000)  # recent handler times in seconds
+
 async def all_chat_download(update):
     """Event handler for new messages in all chats."""
-    message = update.message
-    chat_id = message.chat_id or message.to_id
+    started = time.perf_counter()
+    live_metrics['events'] += 1
+    try:
+        await _download_live_message(update.message)
+    finally:
+        live_latency.append(time.perf_counter() - started)
+
+async def _download_live_message(message):
+    # Most chat traffic carries no media; drop it before any lookup
+    if not message.media: return
+    live_metrics['media'] += 1
     
+    if storage.whitelist and not storage.is_whitelisted(message.chat_id):
+        return
+    
+    # Album members arrive as separate events; queue them together once the album is complete
+    if message.grouped_id:
+        albums.collect(message, _queue_live_messages)
+        return
+    await _queue_live_messages([message])
+
+async def _queue_live_messages(messages_to_queue):
+    chat_id = messages_to_queue[0].chat_id
     try:
-        entity = await state.client.get_entity(chat_id)
+        entity = await messages.get_entity(chat_id, source='live')
     except Exception as e:
         logger.error(f"Failed to get entity for chat_id {chat_id}: {e}")
         return
     
-    entity_id = entity.id
-    chat_title = getattr(entity, 'title', str(entity_id))
-    
-    if storage.whitelist:
-        variants = [entity_id, -entity_id]
-        if entity_id > 0: variants.append(int(f"-100{entity_id}"))
-        id_str = str(entity_id)
-        if id_str.startswith("-100") and len(id_str) > 4:
-            actual_id = int(id_str[4:])
-            variants.extend([actual_id, -actual_id])
-        
-        if not any(v in storage.whitelist for v in set(variants)):
-            return
-    
-    if not message.media: return
-    
-    logger.info(f"Auto-downloading media from: {chat_title}")
-    await downloader.queue_message_for_download(message, entity, chat_title)
+    chat_title = getattr(entity, 'title', str(entity.id))
+    logger.info(f"Auto-downloading {len(messages_to_queue)} media from: {chat_title}")
+    for message in messages_to_queue:
+        if await downloader.queue_message_for_download(message, entity, chat_title, lane='live'):
+            live_metrics['queued'] += 1
+
+async def chat_action_handler(update):
+    """Forget a chat's cached entity when its title or photo changes."""
+    if update.new_title or update.new_photo:
+        messages.forget_entity(update.chat_id)
+
+def register_live_listener():
+    """Register the all-chat download and chat action handlers once; returns False if already registered."""
+    if state.all_chat_listener_registered:
+        return False
+    state.client.add_event_handler(all_chat_download, events.NewMessage())
+    state.client.add_event_handler(chat_action_handler, events.ChatAction())
+    state.all_chat_listener_registered = True
+    return True
+
+def live_stats():
+    """Live handler counters, latency percentiles (ms) and Telegram entity lookups per 1,000 events."""
+    latencies = sorted(live_latency)
+    pct = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else 0
+    events_seen = live_metrics['events']
+    lookups = messages.metrics['entity_lookups'].get('live', 0)
+    return {
+        **live_metrics, 'p50_ms': pct(0.5), 'p95_ms': pct(0.95),
+        'lookups_per_1000': lookups * 1000 / events_seen if events_seen else 0
+    }
 
 async def start_handler(update):
     """Help command handler."""
@@ -45,6 +91,7 @@ async def start_handler(update):
         'Bot command reference:\n\n'
         '/download <link> [<start>] [<end>] or /dl - Start downloads.\n'
         '/stats or /s - Show statistics.\n'
+        '/check_stats - Recount stored progress and repair statistics.\n'
         '/resume [<channel_id>] or /r - Resume downloads.\n\n'
         '/whitelist_add <id...> or /wa - Add to whitelist.\n'
         '/whitelist_list or /wl - List whitelist.\n'
@@ -56,9 +103,69 @@ async def start_handler(update):
 async def stats_handler(update):
     """Show live and database statistics."""
     stats = storage.get_download_stats()
-    msg = f"📊 Stats:\nDB: {stats['completed']} done, {stats['failed']} failed, {stats['pending']} pending\nQueue: {state.queue.qsize()}\nActive: {len(state.active_downloads)}"
+    pm = storage.get_progress_metrics()
+    msg = f"📊 Stats:\nDB: {stats['completed']} done ({utils.bytes_to_string(stats['bytes'])}), {stats['failed']} failed, {stats['pending']} pending\nQueue: {state.queue.qsize()}\nActive: {len(state.active_downloads)}"
+    for lane, ls in state.queue.lane_stats().items():
+        msg += f"\nLane {lane}: {ls['depth']} queued ({ls['on_disk']} not yet in memory) from {ls['channels']} channels, wait p50 {ls['p50']:.0f}s / p95 {ls['p95']:.0f}s / p99 {ls['p99']:.0f}s"
+    fs = messages.fetch_stats()
+    if fs['fetches']:
+        msg += f"\nMessage fetches: {fs['fetches']} ({fs['cache_hits']} prefetched), {fs['api_calls']} requests ({fs['calls_per_message']:.2f} per message)"
+    live = live_stats()
+    if live['events']:
+        msg += f"\nLive handler: {live['events']} events ({live['media']} with media, {live['queued']} queued), p50 {live['p50_ms']:.1f}ms / p95 {live['p95_ms']:.1f}ms, {live['lookups_per_1000']:.1f} entity lookups per 1000 events"
+    disk = diskspace.disk_stats()
+    msg += f"\nDisk: {utils.bytes_to_string(disk['free'])} free of {utils.bytes_to_string(disk['total'])}, {utils.bytes_to_string(disk['reserved'])} reserved by {disk['reservations']} downloads"
+    if disk['waits'] or disk['enospc']:
+        msg += f", {disk['waiting']} waiting for space ({disk['waits']} waits, {disk['wait_seconds']:.0f}s), {disk['enospc']} out-of-space errors"
+    if disk['too_large']:
+        msg += f", {disk['too_large']} files too large for the disk"
+    dd = dedup.dedup_stats()
+    if dd['reused']:
+        msg += f"\nDuplicate content: {dd['reused']} files reused ({', '.join(f'{m} {c}' for m, c in dd['modes'].items())}), {utils.bytes_to_string(dd['bytes_saved'])} not downloaded again"
+    al = albums.album_stats()
+    if al['albums']:
+        msg += f"\nAlbum captions: {al['albums']} albums, {al['hits']} hits / {al['misses']} misses, {al['api_calls']} requests ({al['calls_per_album']:.2f} per album)"
+    last_scan = scanner.metrics['last']
+    if last_scan:
+        msg += f"\nLast scan: {last_scan['scanned']} messages of {last_scan['channel']} in {last_scan['ranges']} ranges at {last_scan['rate']:.0f} msg/s, {last_scan['queued']} queued"
+    journal = state.queue.store.journal_stats()
+    msg += f"\nQueue journal: {journal['tasks']} tasks ({journal['claimed']} claimed)"
+    msg += f"\nMemory: {utils.bytes_to_string(utils.get_rss())} RSS"
+    if state.download_stalls:
+        msg += f"\nStalled downloads cancelled and retried: {state.download_stalls}"
+    limiter = state.download_limiter
+    if config.ADAPTIVE_CONCURRENCY:
+        msg += f"\nWorkers: {limiter.active}/{limiter.limit} (adaptive {limiter.min_limit}-{limiter.max_limit}), timeouts: {state.download_timeouts}, stalls: {state.download_stalls}"
+        if limiter.decisions:
+            last = limiter.decisions[-1]
+            msg += f"\nLast change {int(time.time() - last['time'])}s ago: {last['from']} -> {last['to']} ({last['reason']})"
+    gm = governor.metrics
+    if gm['requests']:
+        calls = ', '.join(f"{k} {n} (waited {gm['waited'][k]:.0f}s)" for k, n in sorted(gm['requests'].items()))
+        msg += f"\nTelegram requests: {calls}"
+    msg += f"\nFloodWaits: {gm['flood_waits']} ({gm['flood_wait_seconds']}s)"
+    if governor.paused_for() > 0:
+        msg += f", paused for {governor.paused_for():.0f}s more"
+    for mode, t in transfer.throughput_summary().items():
+        if t['files']:
+            msg += f"\nDownload throughput ({mode}): {utils.bytes_to_string(t['rate'])}/s over {t['files']} files"
+    if config.UPLOAD_FILE_SET:
+        up = uploader.stage_stats()
+        msg += f"\nUpload stage: {up['queued']} queued ({utils.bytes_to_string(up['backlog_bytes'])}), {up['active']} active, {utils.bytes_to_string(up['rate'])}/s"
+    if retries.pending_count():
+        msg += f"\nRetries scheduled: {retries.pending_count()} (next in {retries.next_due():.0f}s)"
+    if state.streamed_bytes:
+        msg += f"\nStreamed: {utils.bytes_to_string(state.streamed_bytes)} straight to remote (no local disk writes)"
+    if state.resumed_bytes:
+        msg += f"\nResumed: {utils.bytes_to_string(state.resumed_bytes)} reused from partial downloads"
+    msg += f"\nProgress store ({pm['backend']}): {pm['writes']} updates, {pm['flushes']} flushes ({pm['flushes_per_sec']:.2f}/s)"
     await update.reply(msg)
 
+async def reconcile_handler(update):
+    """Recount stored progress and repair the aggregate counters."""
+    stats = storage.reconcile_download_stats()
+    await update.reply(f"Counters reconciled: {stats['completed']} done, {stats['failed']} failed, {stats['pending']} pending")
+
 async def resume_handler(update):
     """Handle /resume command."""
     text = update.message.text.split()
@@ -79,12 +186,12 @@ async def whitelist_add_handler(update):
                 storage.whitelist.append(nid)
                 added.append(nid)
     if added:
+        storage.refresh_whitelist()
         storage.save_whitelist_to_file(storage.whitelist)
         if not config.DOWNLOAD_ALL_ENV_SET and not state.download_all_chat:
             state.download_all_chat = True
-            if state.client and not state.all_chat_listener_registered:
-                state.client.add_event_handler(all_chat_download, events.NewMessage())
-                state.all_chat_listener_registered = True
+            if state.client:
+                register_live_listener()
         await update.reply(f'Added: {added}')
     else:
         await update.reply('No new IDs added')
@@ -102,6 +209,7 @@ async def whitelist_remove_handler(update):
                 storage.whitelist.remove(nid)
                 removed.append(nid)
     if removed:
+        storage.refresh_whitelist()
         storage.save_whitelist_to_file(storage.whitelist)
         if not config.DOWNLOAD_ALL_ENV_SET and not storage.whitelist:
             state.download_all_chat = False
@@ -110,6 +218,7 @@ async def whitelist_remove_handler(update):
 async def whitelist_clear_handler(update):
     """Clear whitelist."""
     storage.whitelist = []
+    storage.refresh_whitelist()
     storage.save_whitelist_to_file([])
     await update.reply('Whitelist cleared')
 
@@ -131,8 +240,8 @@ async def download_handler(update):
     try:
         entity = await state.client.get_entity(link)
         await update.reply(f"Scanning {entity.title}...")
-        queued, _, _ = await downloader.process_channel_messages(entity, entity.title, offset_id=start_id, end_id=end_id)
-        await update.reply(f"Queued {queued} messages.")
+        queued, _, scanned = await scanner.scan_channel(entity, entity.title, start_id=start_id, end_id=end_id)
+        await update.reply(f"Queued {queued} of {scanned} scanned messages ({scanner.metrics['last']['rate']:.0f} msg/s).")
     except Exception as e:
         await update.reply(f"Error: {e}")
 
@@ -141,6 +250,7 @@ def register_handlers(bot_instance):
     admin_ids = config.ADMIN_IDS
     bot_instance.add_event_handler(start_handler, events.NewMessage(pattern='/start', from_users=admin_ids))
     bot_instance.add_event_handler(stats_handler, events.NewMessage(pattern=r'/(stats|s)', from_users=admin_ids))
+    bot_instance.add_event_handler(reconcile_handler, events.NewMessage(pattern='/check_stats', from_users=admin_ids))
     bot_instance.add_event_handler(resume_handler, events.NewMessage(pattern=r'/(resume|r)', from_users=admin_ids))
     bot_instance.add_event_handler(whitelist_add_handler, events.NewMessage(pattern=r'/(whitelist_add|wa)', from_users=admin_ids))
     bot_instance.add_event_handler(whitelist_remove_handler, events.NewMessage(pattern=r'/(whitelist_remove|wr)', from_users=admin_ids))
@@ -0,0 +1,87 @@
+import time
+import asyncio
+import logging
+from collections import deque
+import config
+import state
+
+logger = logging.getLogger('tg_downloader')
+
+class AdaptiveLimiter:
+    """Counting limiter for download workers whose limit can change at runtime."""
+
+    def __init__(self, limit, min_limit, max_limit):
+        self.min_limit = max(1, min(min_limit, max_limit))
+        self.max_limit = max(1, max_limit)
+        self.limit = self._clamp(limit)
+        self.active = 0
+        self._changed = asyncio.Event()
+        self.decisions = deque(maxlen=20)
+
+    def _clamp(self, limit):
+        return max(self.min_limit, min(self.max_limit, limit))
+
+    async def acquire(self):
+        while self.active >= self.limit:
+            self._changed.clear()
+            await self._changed.wait()
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._changed.set()
+
+    def resize(self, limit, reason):
+        """Change the limit; workers above a lower limit finish their current file first."""
+        limit = self._clamp(limit)
+        if limit != self.limit:
+            logger.info(f'Download concurrency {self.limit} -> {limit}: {reason}')
+            self.decisions.append({'time': time.time(), 'from': self.limit, 'to': limit, 'reason': reason})
+            self.limit = limit
+            self._changed.set()
+
+class AimdController:
+    """Additive-increase / multiplicative-decrease tuning of the download limiter.
+
+    Halves the limit when file FloodWaits or timeouts were seen in the last interval, adds one
+    worker while all slots are busy and throughput keeps up, and steps back when the last
+    increase made throughput drop.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.last_time = time.time()
+        self.last_bytes = state.downloaded_bytes
+        self.last_flood_waits = state.flood_waits
+        self.last_timeouts = state.download_timeouts + state.download_stalls
+        self.last_rate = 0
+        self.last_increased = False
+        self.rate = 0
+
+    def step(self):
+        now = time.time()
+        elapsed = max(now - self.last_time, 1e-6)
+        rate = (state.downloaded_bytes - self.last_bytes) / elapsed
+        flood_waits = state.flood_waits - self.last_flood_waits
+        timeouts = state.download_timeouts + state.download_stalls - self.last_timeouts
+        self.last_time, self.last_bytes = now, state.downloaded_bytes
+        self.last_flood_waits, self.last_timeouts = state.flood_waits, state.download_timeouts + state.download_stalls
+
+        limit = self.limiter.limit
+        increased = False
+        if flood_waits or timeouts:
+            self.limiter.resize(limit // 2, f'{flood_waits} FloodWait(s), {timeouts} timeout(s)/stall(s)')
+        elif self.last_increased and rate < self.last_rate * 0.9:
+            self.limiter.resize(limit - 1, 'throughput dropped after last increase')
+        elif len(state.active_downloads) >= limit and state.queue.qsize() > 0:
+            self.limiter.resize(limit + 1, 'all workers busy with files waiting')
+            increased = self.limiter.limit > limit
+        self.last_increased = increased
+        self.last_rate = rate
+        self.rate = rate
+
+def create_limiter():
+    """Download limiter: fixed at MAX_NUM unless ADAPTIVE_CONCURRENCY is enabled."""
+    if not config.ADAPTIVE_CONCURRENCY:
+        return AdaptiveLimiter(config.MAX_NUM, config.MAX_NUM, config.MAX_NUM)
+    return AdaptiveLimiter(config.MIN_NUM, config.MIN_NUM, config.MAX_NUM)
@@ -111,7 +111,34 @@ UPLOAD_FILE_SET = parse_bool_env('UPLOAD_FLAG')
 DRIVE_NAME = os.environ.get('DRIVE_NAME', '')
 DRIVE_PATH = os.environ.get('DRIVE_PATH', '')
 OPERATE = os.environ.get('OPERATE', 'move')
+UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', 4))
+RCLONE_RC_ADDR = os.environ.get('RCLONE_RC_ADDR', '127.0.0.1:5572')
+UPLOAD_QUEUE_MAX_FILES = int(os.environ.get('UPLOAD_QUEUE_MAX_FILES', 100))
+UPLOAD_QUEUE_MAX_MB = int(os.environ.get('UPLOAD_QUEUE_MAX_MB', 10240))
+UPLOAD_BATCH_SIZE = int(os.environ.get('UPLOAD_BATCH_SIZE', 50))
+UPLOAD_BATCH_WAIT = int(os.environ.get('UPLOAD_BATCH_WAIT', 30))
+UPLOAD_BATCH_MAX_FILE_KB = int(os.environ.get('UPLOAD_BATCH_MAX_FILE_KB', 1024))
+UPLOAD_BATCH_TRANSFERS = int(os.environ.get('UPLOAD_BATCH_TRANSFERS', 8))
+UPLOAD_MAX_RETRIES = int(os.environ.get('UPLOAD_MAX_RETRIES', 8))
+STREAM_UPLOAD = parse_bool_env('STREAM_UPLOAD')
+STREAM_BUFFER_MB = int(os.environ.get('STREAM_BUFFER_MB', 32))
 MAX_NUM = int(os.environ.get('MAX_NUM', 10))
+ADAPTIVE_CONCURRENCY = parse_bool_env('ADAPTIVE_CONCURRENCY')
+MIN_NUM = int(os.environ.get('MIN_NUM', 2))
+CONCURRENCY_ADJUST_INTERVAL = int(os.environ.get('CONCURRENCY_ADJUST_INTERVAL', 30))
+
+# Telegram request governor (requests per second, 0 = unlimited)
+RATE_LIMIT_HISTORY = int(os.environ.get('RATE_LIMIT_HISTORY', 5))
+RATE_LIMIT_FILE = int(os.environ.get('RATE_LIMIT_FILE', 0))
+RATE_LIMIT_ENTITY = int(os.environ.get('RATE_LIMIT_ENTITY', 2))
+FLOOD_SLEEP_THRESHOLD = int(os.environ.get('FLOOD_SLEEP_THRESHOLD', 60))
+RETRY_MAX_DELAY = int(os.environ.get('RETRY_MAX_DELAY', 1800))
+SMALL_FILE_FIRST_KB = int(os.environ.get('SMALL_FILE_FIRST_KB', 0))
+QUEUE_MEMORY_ITEMS = int(os.environ.get('QUEUE_MEMORY_ITEMS', 10000))
+MESSAGE_FETCH_WINDOW_MS = int(os.environ.get('MESSAGE_FETCH_WINDOW_MS', 50))
+MESSAGE_PREFETCH = int(os.environ.get('MESSAGE_PREFETCH', 50))
+MESSAGE_CACHE_TTL = int(os.environ.get('MESSAGE_CACHE_TTL', 600))
+ENTITY_CACHE_TTL = int(os.environ.get('ENTITY_CACHE_TTL', 3600))
 FILTER_LIST_STR = os.environ.get('FILTER_LIST', '')
 WHITELIST_STR = os.environ.get('WHITE_LIST', '')
 WHITELIST_FILE = os.environ.get('WHITELIST_FILE', 'whitelist.txt')
@@ -119,8 +146,20 @@ DOWNLOAD_ALL_ENV_SET = parse_bool_env('DOWNLOAD_ALL')
 FILTER_FILE_TYPE_STR = os.environ.get('FILTER_FILE_TYPE', '')
 SAVE_PATH = 'downloads'
 
+# Large-file parallel download settings
+PARALLEL_DOWNLOAD_THRESHOLD_MB = int(os.environ.get('PARALLEL_DOWNLOAD_THRESHOLD_MB', 64))
+PARALLEL_DOWNLOAD_PARTS = int(os.environ.get('PARALLEL_DOWNLOAD_PARTS', 4))
+DOWNLOAD_CHECKPOINT_MB = int(os.environ.get('DOWNLOAD_CHECKPOINT_MB', 8))
+DISK_HIGH_WATER = int(os.environ.get('DISK_HIGH_WATER', 90))
+DOWNLOAD_BUFFER_KB = int(os.environ.get('DOWNLOAD_BUFFER_KB', 1024))
+DOWNLOAD_PREALLOCATE = parse_bool_env('DOWNLOAD_PREALLOCATE', True)
+
 # Timeout and health check settings
 DOWNLOAD_TIMEOUT = int(os.environ.get('DOWNLOAD_TIMEOUT', 1800))
+DOWNLOAD_TIMEOUT_RATE_KB = int(os.environ.get('DOWNLOAD_TIMEOUT_RATE_KB', 256))
+STALL_TIMEOUT = int(os.environ.get('STALL_TIMEOUT', 60))
+STALL_MIN_RATE_KB = int(os.environ.get('STALL_MIN_RATE_KB', 0))
+STALL_RATE_WINDOW = int(os.environ.get('STALL_RATE_WINDOW', 120))
 HEALTH_CHECK_INTERVAL = int(os.environ.get('HEALTH_CHECK_INTERVAL', 300))
 MAX_IDLE_TIME = int(os.environ.get('MAX_IDLE_TIME', 600))
 MAX_RETRIES = int(os.environ.get('MAX_RETRIES', 3))
@@ -131,9 +170,17 @@ PROGRESS_REPORT_INTERVAL = int(os.environ.get('PROGRESS_REPORT_INTERVAL', 600))
 AUTO_RESUME = parse_bool_env('AUTO_RESUME')
 REPORT_PERCENT_STEP = int(os.environ.get('REPORT_PERCENT_STEP', 1))
 REPORT_MIN_INTERVAL = int(os.environ.get('REPORT_MIN_INTERVAL', 180))
+PROGRESS_BACKEND = os.environ.get('PROGRESS_BACKEND', 'sqlite').lower()
+CONTENT_DEDUP = os.environ.get('CONTENT_DEDUP', 'copy').lower()
+PROGRESS_DB_FILE = os.environ.get('PROGRESS_DB_FILE', os.path.join(PROGRESS_DIR, 'progress.db'))
+PROGRESS_COMMIT_BATCH = int(os.environ.get('PROGRESS_COMMIT_BATCH', 500))
+PROGRESS_FLUSH_INTERVAL = int(os.environ.get('PROGRESS_FLUSH_INTERVAL', 2))
+COMPLETION_MAX_RANGES = int(os.environ.get('COMPLETION_MAX_RANGES', 1000))
 
 # Scanning throttle settings
 SCAN_BATCH_SIZE = int(os.environ.get('SCAN_BATCH_SIZE', 100))
+SCAN_PARALLELISM = int(os.environ.get('SCAN_PARALLELISM', 4))
+SCAN_MEDIA_FILTERS = os.environ.get('SCAN_MEDIA_FILTERS', '')
 DOWNLOAD_BATCH_SIZE = int(os.environ.get('DOWNLOAD_BATCH_SIZE', 50))
 
 # Proxy
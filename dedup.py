@@ -0,0 +1,173 @@
+import os
+import time
+import asyncio
+import shutil
+import sqlite3
+import logging
+import config
+import transfer
+import uploader
+
+logger = logging.getLogger('tg_downloader')
+
+_index = None
+
+class ContentIndex:
+    """SQLite index of saved content by Telegram media id and size, plus the messages served from it."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS content (
+            content_id TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            local_path TEXT,
+            remote_dir TEXT,
+            file_name TEXT,
+            PRIMARY KEY (content_id, size)
+        )''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS refs (
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            content_id TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mode TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (channel_id, message_id)
+        )''')
+        # Content of files handed to the upload stage, recorded once their upload finishes (also after a restart)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS uploading (
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            content_id TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (channel_id, message_id)
+        )''')
+
+    def get(self, content_id, size):
+        """(local_path, remote_dir, file_name) of saved content, or None."""
+        return self.conn.execute(
+            'SELECT local_path, remote_dir, file_name FROM content WHERE content_id = ? AND size = ?', (content_id, size)
+        ).fetchone()
+
+    def put(self, content_id, size, local_path=None, remote_dir=None, file_name=None):
+        self.conn.execute(
+            'INSERT INTO content (content_id, size, local_path, remote_dir, file_name) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (content_id, size) DO UPDATE SET local_path = COALESCE(excluded.local_path, local_path), '
+            'remote_dir = COALESCE(excluded.remote_dir, remote_dir), file_name = COALESCE(excluded.file_name, file_name)',
+            (content_id, size, local_path, remote_dir, file_name)
+        )
+
+    def drop(self, content_id, size):
+        self.conn.execute('DELETE FROM content WHERE content_id = ? AND size = ?', (content_id, size))
+
+    def add_ref(self, channel_id, message_id, content_id, size, mode):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO refs (channel_id, message_id, content_id, size, mode, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (channel_id, message_id, content_id, size, mode, time.time())
+        )
+
+    def expect(self, channel_id, message_id, content_id, size):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO uploading (channel_id, message_id, content_id, size) VALUES (?, ?, ?, ?)',
+            (channel_id, message_id, content_id, size)
+        )
+
+    def take_expected(self, channel_id, message_id):
+        """(content_id, size) expected from an upload, or None; the entry is removed."""
+        row = self.conn.execute(
+            'SELECT content_id, size FROM uploading WHERE channel_id = ? AND message_id = ?', (channel_id, message_id)
+        ).fetchone()
+        if row:
+            self.conn.execute('DELETE FROM uploading WHERE channel_id = ? AND message_id = ?', (channel_id, message_id))
+        return row
+
+    def stats(self):
+        entries = self.conn.execute('SELECT COUNT(*) FROM content').fetchone()[0]
+        modes = {mode: (count, saved) for mode, count, saved in self.conn.execute(
+            'SELECT mode, COUNT(*), COALESCE(SUM(size), 0) FROM refs GROUP BY mode'
+        )}
+        return {
+            'entries': entries, 'reused': sum(c for c, _ in modes.values()),
+            'bytes_saved': sum(s for _, s in modes.values()), 'modes': {m: c for m, (c, _) in modes.items()}
+        }
+
+def get_index():
+    """Return the content index, opening it on first use."""
+    global _index
+    if _index is None:
+        _index = ContentIndex(os.path.join(config.PROGRESS_DIR, 'content.db'))
+    return _index
+
+def _enabled(task):
+    return config.CONTENT_DEDUP != 'off' and task.content_id is not None
+
+def record_local(task, path):
+    """Remember where a finished download of a task's content is kept locally."""
+    if _enabled(task):
+        get_index().put(task.content_id, task.size, local_path=path)
+
+def record_remote(task, remote_dir, file_name):
+    """Remember where a task's content was written on the remote."""
+    if _enabled(task):
+        get_index().put(task.content_id, task.size, remote_dir=remote_dir, file_name=file_name)
+
+def expect_upload(task):
+    """Note the content of a file handed to the upload stage, recorded once its upload finishes."""
+    if _enabled(task):
+        get_index().expect(task.channel_id, task.message_id, task.content_id, task.size)
+
+def upload_finished(channel_id, message_id, remote_dir, file_name):
+    index = get_index()
+    content = index.take_expected(channel_id, message_id)
+    if content:
+        index.put(*content, remote_dir=remote_dir, file_name=file_name)
+
+async def reuse(task, download_path, remote_dir):
+    """Serve a task from content saved for another message instead of downloading it again.
+
+    Returns how it was served ('link', 'copy', 'server-copy' or 'reference'), or None to download.
+    """
+    if not _enabled(task):
+        return None
+    try:
+        index = get_index()
+        entry = index.get(task.content_id, task.size)
+        if entry is None:
+            return None
+        local_path, src_dir, src_name = entry
+        if config.CONTENT_DEDUP == 'reference':
+            mode = 'reference'
+        elif config.UPLOAD_FILE_SET:
+            if not src_dir:
+                return None
+            if await uploader.remote_size(src_dir, src_name) is None:
+                # The earlier copy was removed from the remote
+                index.drop(task.content_id, task.size)
+                return None
+            await uploader.copy_remote(src_dir, src_name, remote_dir, task.file_name)
+            mode = 'server-copy'
+        else:
+            if not local_path or not os.path.exists(local_path):
+                index.drop(task.content_id, task.size)
+                return None
+            try:
+                os.link(local_path, download_path)
+                mode = 'link'
+            except OSError:
+                # Different filesystem: a local copy still saves the download. It runs in a thread so a
+                # multi-GB copy does not stall the event loop, and goes through .part like a download
+                part_path = transfer.part_path_for(download_path)
+                await asyncio.get_running_loop().run_in_executor(None, shutil.copyfile, local_path, part_path)
+                os.replace(part_path, download_path)
+                mode = 'copy'
+    except Exception as e:
+        logger.warning(f'Could not reuse saved content for {task.file_name}, downloading it: {e}')
+        return None
+    index.add_ref(task.channel_id, task.message_id, task.content_id, task.size, mode)
+    return mode
+
+def dedup_stats():
+    """Saved content entries, reused messages (per mode) and bytes not downloaded again."""
+    return get_index().stats()
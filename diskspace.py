@@ -0,0 +1,102 @@
+import os
+import time
+import errno
+import asyncio
+import logging
+import config
+import state
+import utils
+import uploader
+
+logger = logging.getLogger('tg_downloader')
+
+# Seconds between free-space checks while a download waits for room
+POLL_INTERVAL = 5
+# Longest a download holds its worker waiting for room before it goes back to the retry schedule
+MAX_WAIT = 600
+
+_reservations = {}  # download key -> (file size, bytes already on disk when reserved)
+_released = None  # set whenever a reservation ends
+metrics = {'waits': 0, 'waiting': 0, 'wait_seconds': 0.0, 'enospc': 0, 'too_large': 0}
+
+class FileTooLarge(Exception):
+    """A file does not fit below DISK_HIGH_WATER even with the filesystem otherwise empty."""
+
+def is_disk_full(error):
+    """Whether an exception means the filesystem (or quota) ran out of space."""
+    return isinstance(error, OSError) and error.errno in (errno.ENOSPC, errno.EDQUOT)
+
+def _statvfs():
+    path = os.path.abspath(config.SAVE_PATH)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.statvfs(path)
+
+def _outstanding():
+    """Bytes reserved by running downloads that are not on disk yet."""
+    total = 0
+    for key, (size, on_disk) in _reservations.items():
+        written = state.active_downloads.get(key, {}).get('downloaded', on_disk)
+        total += max(0, size - written)
+    return total
+
+def headroom():
+    """Bytes that may still be written to SAVE_PATH before its filesystem reaches DISK_HIGH_WATER."""
+    st = _statvfs()
+    total, free = st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize
+    return free - total * (100 - config.DISK_HIGH_WATER) // 100 - _outstanding()
+
+def disk_stats():
+    """Free and total bytes of SAVE_PATH's filesystem, outstanding reservations and wait counters."""
+    st = _statvfs()
+    return {
+        **metrics, 'free': st.f_bavail * st.f_frsize, 'total': st.f_blocks * st.f_frsize,
+        'reserved': _outstanding(), 'reservations': len(_reservations)
+    }
+
+async def reserve(key, size, on_disk=0):
+    """Wait until a file of `size` bytes (`on_disk` of them already written) fits, then reserve it for `key`.
+
+    Raises FileTooLarge if it can never fit, and ENOSPC after MAX_WAIT seconds without room.
+    """
+    global _released
+    if not config.DISK_HIGH_WATER or size <= 0:
+        return
+    st = _statvfs()
+    capacity = st.f_blocks * st.f_frsize * config.DISK_HIGH_WATER // 100
+    if size > capacity:
+        metrics['too_large'] += 1
+        raise FileTooLarge(
+            f'{utils.bytes_to_string(size)} does not fit below DISK_HIGH_WATER '
+            f'({utils.bytes_to_string(capacity)} of {config.SAVE_PATH})'
+        )
+    if _released is None:
+        _released = asyncio.Event()
+    started = None
+    try:
+        while headroom() < size - on_disk:
+            if started is not None and time.time() - started >= MAX_WAIT:
+                raise OSError(errno.ENOSPC, f'No room below DISK_HIGH_WATER after waiting {MAX_WAIT}s')
+            if started is None:
+                started = time.time()
+                metrics['waits'] += 1
+                metrics['waiting'] += 1
+                logger.warning(f'Disk at its high-water mark: holding a {utils.bytes_to_string(size - on_disk)} download until space is freed')
+                if config.UPLOAD_FILE_SET:
+                    # Small files waiting for a batch are uploaded now to free their space
+                    await uploader.flush_batches()
+            _released.clear()
+            try:
+                await asyncio.wait_for(_released.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if started is not None:
+            metrics['waiting'] -= 1
+            metrics['wait_seconds'] += time.time() - started
+    _reservations[key] = (size, on_disk)
+
+def release(key):
+    """End a download's reservation; its bytes are now on disk (or were never written)."""
+    if _reservations.pop(key, None) is not None and _released is not None:
+        _released.set()
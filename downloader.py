@@ -2,50 +2,74 @@ import os
 import time
 import asyncio
 import logging
+from collections import deque
 from telethon import errors
 from telethon.tl.types import MessageMediaWebPage
 import config
 import state
+import albums
+import dedup
+import diskspace
+import governor
 import storage
+import messages
+import retries
+import scheduler
+import transfer
+import uploader
 import utils
 
 logger = logging.getLogger('tg_downloader')
 
-async def get_group_caption(message):
-    """Retrieve caption from a media group with caching."""
-    if not message.grouped_id:
-        return ""
-    
-    # Check cache first
-    if message.grouped_id in state.group_caption_cache:
-        return state.group_caption_cache[message.grouped_id]
-        
-    group_caption = ""
+# Seconds between stall checks of a running transfer
+STALL_CHECK_INTERVAL = 5
+
+class DownloadStalled(Exception):
+    """A transfer was cancelled by the stall watchdog."""
+
+def download_timeout(file_size):
+    """Time limit for one file: DOWNLOAD_TIMEOUT, or longer if the file needs it at DOWNLOAD_TIMEOUT_RATE_KB."""
+    if config.DOWNLOAD_TIMEOUT_RATE_KB <= 0:
+        return config.DOWNLOAD_TIMEOUT
+    return max(config.DOWNLOAD_TIMEOUT, file_size / (config.DOWNLOAD_TIMEOUT_RATE_KB * 1024))
+
+def _stall_reason(info, now):
+    idle = now - info['last_progress']
+    if config.STALL_TIMEOUT and idle > config.STALL_TIMEOUT:
+        return f'no data for {idle:.0f}s'
+    samples = info['samples']
+    if (config.STALL_MIN_RATE_KB and samples and now - samples[0][0] >= config.STALL_RATE_WINDOW
+            and info['rate'] < config.STALL_MIN_RATE_KB * 1024):
+        return f"{utils.bytes_to_string(info['rate'])}/s over {config.STALL_RATE_WINDOW}s"
+    return None
+
+async def _watch(download_key, coro):
+    """Run a transfer, cancelling it with DownloadStalled once it stops making progress."""
+    transfer_task = asyncio.ensure_future(coro)
+    info = state.active_downloads[download_key]
+    info['last_progress'] = time.time()
     try:
-        entity = await state.client.get_entity(message.to_id)
-        # Search nearby messages to find the one with the caption for this grouped_id
-        async for msg in state.client.iter_messages(entity=entity, reverse=True, offset_id=message.id - 9, limit=10):
-            if msg.grouped_id == message.grouped_id:
-                if msg.text:
-                    group_caption = msg.text
-                    break
-        
-        # Cache the result (even if empty) to avoid re-scanning
-        state.group_caption_cache[message.grouped_id] = group_caption
-        # Limit cache size to avoid memory issues (simple FIFO-ish cleanup)
-        if len(state.group_caption_cache) > 500:
-            # Clear about 10% of the cache
-            keys_to_remove = list(state.group_caption_cache.keys())[:50]
-            for k in keys_to_remove:
-                del state.group_caption_cache[k]
-                
-    except Exception as e:
-        logger.error(f"Error getting group caption: {e}")
-    return group_caption
+        while True:
+            done, _ = await asyncio.wait({transfer_task}, timeout=STALL_CHECK_INTERVAL)
+            if done:
+                return transfer_task.result()
+            now = time.time()
+            if governor.paused_for() > 0:
+                # Every transfer waits out a FloodWait pause; that is not a stall
+                info['last_progress'] = now
+                info['samples'] = deque([(now, info['downloaded'])])
+                continue
+            reason = _stall_reason(info, now)
+            if reason:
+                raise DownloadStalled(f'Download stalled: {reason}')
+    finally:
+        if not transfer_task.done():
+            transfer_task.cancel()
+            await asyncio.gather(transfer_task, return_exceptions=True)
 
 async def build_file_name_from_message(message, entity):
     """Extract and build file name from a Telegram message."""
-    caption = await get_group_caption(message) if (message.grouped_id and message.text == "") else message.text
+    caption = await albums.caption(message, entity) if (message.grouped_id and message.text == "") else message.text
     
     filter_list = config.FILTER_LIST_STR.split(' ') if config.FILTER_LIST_STR else []
     
@@ -82,13 +106,15 @@ async def build_file_name_from_message(message, entity):
     
     return file_name, False
 
-async def queue_message_for_download(message, entity, chat_title, file_name=None):
-    """Queue a message for download."""
+async def prepare_task(message, entity, chat_title, file_name=None):
+    """Build the DownloadTask for a message and create its folder; None if it is skipped or already retrying."""
     try:
+        if retries.is_scheduled(entity.id, message.id):
+            return None
         if file_name is None:
             file_name, should_skip = await build_file_name_from_message(message, entity)
             if should_skip or not file_name:
-                return False
+                return None
         
         dirname = utils.validate_title(f'{chat_title}({entity.id})')
         datetime_dir_name = message.date.strftime("%Y-%m")
@@ -97,8 +123,6 @@ async def queue_message_for_download(message, entity, chat_title, file_name=None
         if not os.path.exists(file_save_path):
             os.makedirs(file_save_path, exist_ok=True)
         
-        download_path = os.path.join(file_save_path, file_name)
-        
         file_size = 0
         try:
             if message.document:
@@ -108,9 +132,20 @@ async def queue_message_for_download(message, entity, chat_title, file_name=None
         except:
             pass
         
+        return scheduler.DownloadTask.from_message(message, entity, chat_title, file_name, file_size)
+    except Exception as e:
+        logger.error(f'Error queueing message {message.id} from {chat_title}: {e}')
+        return None
+
+async def queue_message_for_download(message, entity, chat_title, file_name=None, lane='backfill'):
+    """Queue a message for download on a scheduler lane ('live' or 'backfill')."""
+    task = await prepare_task(message, entity, chat_title, file_name)
+    if task is None:
+        return False
+    try:
         storage.record_file_start(entity.id, chat_title, message.id)
-        await state.queue.put((message, chat_title, entity, file_name))
-        return True
+        messages.remember_entity(entity)
+        return await state.queue.put(task, lane=lane)
     except Exception as e:
         logger.error(f'Error queueing message {message.id} from {chat_title}: {e}')
         return False
@@ -118,174 +153,247 @@ async def queue_message_for_download(message, entity, chat_title, file_name=None
 async def worker(name):
     """Worker loop for downloading files."""
     while True:
-        queue_item = await state.queue.get()
-        message, chat_title, entity, file_name = queue_item
-        
-        filter_file_types = config.FILTER_FILE_TYPE_STR.split(' ') if config.FILTER_FILE_TYPE_STR else []
-        should_skip = any(file_name.endswith(ft) for ft in filter_file_types)
-        if should_skip:
-            logger.info(f"Skipping filtered file: {file_name}")
-            state.queue.task_done()
-            continue
-        
-        channel_id, message_id = entity.id, message.id
-        file_status = storage.get_file_status(channel_id, message_id)
-        
-        if file_status:
-            status, _, retry_count = file_status
-            if status == 'completed':
-                state.queue.task_done()
+        await uploader.wait_for_capacity()
+        await state.download_limiter.acquire()
+        try:
+            task = await state.queue.get()
+            if task is None:
                 continue
-            if retry_count >= config.MAX_RETRIES:
+            try:
+                # Tasks handed to the upload stage stay journaled until their upload finishes, and a task
+                # interrupted by shutdown (CancelledError) stays journaled to run again on the next start
+                if not await process_task(name, task):
+                    state.queue.ack(task.channel_id, task.message_id)
+            except Exception as e:
+                # Keep the worker alive: the task goes through the normal failure and retry path
+                logger.error(f"[{name}] Unexpected error processing {task.file_name}: {e}")
+                try:
+                    _record_failure(task, str(e))
+                    state.queue.ack(task.channel_id, task.message_id)
+                except Exception as e:
+                    # Left journaled; it runs again on the next start
+                    logger.error(f"[{name}] Could not record the failure of {task.file_name}: {e}")
+            finally:
                 state.queue.task_done()
-                continue
-        
-        dirname = utils.validate_title(f'{chat_title}({entity.id})')
-        datetime_dir_name = message.date.strftime("%Y-%m")
-        file_save_path = os.path.join(config.SAVE_PATH, dirname, datetime_dir_name)
-        if not os.path.exists(file_save_path):
-            os.makedirs(file_save_path)
+        finally:
+            state.download_limiter.release()
+
+def _record_failure(task, error_msg, retry_class='error', retry_wait=0):
+    """Count a failed attempt and schedule the retry; returns the file's status afterwards."""
+    storage.record_file_complete(task.channel_id, task.message_id, 'failed', error_msg)
+    status = storage.get_file_status(task.channel_id, task.message_id)
+    if status and status[0] == 'downloading':
+        retries.schedule(task, retry_class, status[2], retry_wait)
+    return status
+
+async def process_task(name, task):
+    """Download one queued task and record the result; returns True if it was handed to the upload stage."""
+    channel_id, message_id = task.channel_id, task.message_id
+    chat_title, file_name, file_size = task.chat_title, task.file_name, task.size
+    
+    filter_file_types = config.FILTER_FILE_TYPE_STR.split(' ') if config.FILTER_FILE_TYPE_STR else []
+    should_skip = any(file_name.endswith(ft) for ft in filter_file_types)
+    if should_skip:
+        logger.info(f"Skipping filtered file: {file_name}")
+        return
+    
+    file_status = storage.get_file_status(channel_id, message_id)
+    
+    if file_status:
+        status, _, retry_count = file_status
+        if status == 'completed':
+            return
+        if retry_count >= config.MAX_RETRIES:
+            return
+    
+    dirname = utils.validate_title(f'{chat_title}({channel_id})')
+    datetime_dir_name = task.month
+    file_save_path = os.path.join(config.SAVE_PATH, dirname, datetime_dir_name)
+    if not os.path.exists(file_save_path):
+        os.makedirs(file_save_path)
+    
+    download_path = os.path.join(file_save_path, file_name)
+    # Downloads land in a .part file and are renamed when complete, so an existing path is a finished file
+    already_downloaded = os.path.exists(download_path)
+    if (already_downloaded and file_status and file_status[0] == 'downloading'
+            and file_size and os.path.getsize(download_path) != file_size):
+        # Left by a version that wrote to the final path directly: an interrupted, truncated download
+        logger.warning(f"[{name}] Discarding incomplete {file_name} ({os.path.getsize(download_path)} of {file_size} bytes)")
+        os.remove(download_path)
+        already_downloaded = False
+    if already_downloaded and not (file_status and file_status[0] == 'downloading'):
+        storage.record_file_complete(channel_id, message_id, 'completed', file_size=os.path.getsize(download_path))
+        return
+    
+    remote_dir = uploader.remote_dir_for(dirname, datetime_dir_name)
+    # Stream mode pipes documents straight into rclone; photos and finished files take the upload stage
+    streamed = (
+        config.UPLOAD_FILE_SET and config.STREAM_UPLOAD
+        and task.mime is not None and not already_downloaded
+    )
+    
+    # The same file reposted in another chat is linked or copied from the saved one
+    reused = not already_downloaded and await dedup.reuse(task, download_path, remote_dir)
+    if reused:
+        logger.info(f"[{name}] Reused saved content for {file_name} ({reused}, {utils.bytes_to_string(file_size)} not downloaded)")
+        storage.record_file_complete(channel_id, message_id, 'completed', file_size=file_size)
+        return
+    
+    # storage.record_file_start is already called in queue_message_for_download
+    download_key = f"{channel_id}_{message_id}"
+    if not streamed and not already_downloaded:
+        part_path = transfer.part_path_for(download_path)
+        try:
+            await diskspace.reserve(download_key, file_size, os.path.getsize(part_path) if os.path.exists(part_path) else 0)
+        except diskspace.FileTooLarge as e:
+            logger.error(f"[{name}] Giving up on {file_name}: {e}")
+            storage.record_file_complete(channel_id, message_id, 'failed', str(e), final=True)
+            return False
+        except OSError as e:
+            if not diskspace.is_disk_full(e):
+                logger.error(f"[{name}] Could not reserve space for {file_name}: {e}")
+                _record_failure(task, str(e))
+                return False
+            # Free the worker for files that fit; this one waits in the retry schedule
+            logger.warning(f"[{name}] {file_name}: {e}")
+            retries.schedule(task, 'disk', 1)
+            return False
+    state.active_downloads[download_key] = {
+        'file_name': file_name, 
+        'start_time': time.time(), 
+        'file_size': file_size,
+        'downloaded': 0,
+        'last_progress': time.time(),
+        'rate': 0,
+        'samples': deque()  # (time, downloaded) over the last STALL_RATE_WINDOW seconds
+    }
+    
+    logger.info(f"[{name}] Starting download: {chat_title} - {file_name} ({utils.bytes_to_string(file_size)})")
+    if not state.first_download_at:
+        state.first_download_at = time.time()
+        logger.info(f"First download started {state.first_download_at - state.started_at:.1f}s after startup")
+    
+    download_success = False
+    handed_off = False
+    error_msg = None
+    retry_class, retry_wait = 'error', 0
+    
+    async def progress_callback(downloaded, total):
+        state.update_active_download(download_key, downloaded)
+        # Optional: trigger quick report if percent jumps significantly? 
+        # For now, let the periodic task handle it or completion.
+    
+    try:
+        await state.update_download_activity()
+        if not already_downloaded:
+            # Fetched right before downloading so the file reference is fresh
+            message = await messages.fetch(channel_id, message_id)
+            if not message or not message.media:
+                raise ValueError('Message no longer available')
+        if already_downloaded:
+            logger.info(f"[{name}] Found finished download: {file_name}")
+        elif streamed:
+            started = time.time()
+            sent = await asyncio.wait_for(
+                _watch(download_key, transfer.stream_message(state.client, message, remote_dir, file_name, file_size, progress_callback)),
+                timeout=download_timeout(file_size)
+            )
+            rate = transfer.record_throughput(file_name, sent, time.time() - started, 1, streamed=True)
+            logger.info(f"[{name}] Streamed to remote: {file_name} ({utils.bytes_to_string(rate)}/s)")
+        else:
+            resume_offset = storage.get_resume_offset(channel_id, message_id)
+            state.active_downloads[download_key]['downloaded'] = resume_offset
+            if resume_offset:
+                logger.info(f"[{name}] Resuming {file_name} from {utils.bytes_to_string(resume_offset)}")
+            started = time.time()
+            parts = await asyncio.wait_for(_watch(
+                download_key,
+                transfer.download_message(
+                    state.client, message, download_path, file_size, progress_callback,
+                    offset=resume_offset,
+                    checkpoint=lambda offset: storage.record_download_offset(channel_id, message_id, offset),
+                    # A preallocated file already holds its space, so the reservation is no longer needed
+                    allocated=lambda: diskspace.release(download_key)
+                )),
+                timeout=download_timeout(file_size)
+            )
+            rate = transfer.record_throughput(file_name, file_size - resume_offset, time.time() - started, parts)
+            logger.info(f"[{name}] Download completed: {file_name} ({utils.bytes_to_string(rate)}/s, {parts} part(s))")
         
-        download_path = os.path.join(file_save_path, file_name)
-        if os.path.exists(download_path):
-            file_size = os.path.getsize(download_path)
-            if file_status and file_status[0] == 'downloading':
-                try: os.remove(download_path)
-                except: pass
+        if streamed or os.path.exists(download_path):
+            download_success = True
+        else:
+            error_msg = "File not found after download"
+    except asyncio.TimeoutError:
+        error_msg = "Download timeout"
+        state.download_timeouts += 1
+        retry_class = 'timeout'
+    except errors.FloodWaitError as e:
+        # The governor already holds every Telegram request until the wait is over
+        error_msg = f"FloodWait: {e.seconds}s"
+        retry_class, retry_wait = 'floodwait', e.seconds
+    except (errors.FileReferenceExpiredError, errors.FileReferenceInvalidError):
+        error_msg = "File reference expired"
+        retry_class = 'reference'
+    except DownloadStalled as e:
+        error_msg = str(e)
+        state.download_stalls += 1
+        retry_class = 'stall'
+    except Exception as e:
+        error_msg = str(e)
+        retry_class = 'disk' if diskspace.is_disk_full(e) else 'error'
+    finally:
+        diskspace.release(download_key)
+        if download_key in state.active_downloads:
+            del state.active_downloads[download_key]
+        if download_success and config.UPLOAD_FILE_SET and not streamed:
+            # Completion is recorded by the upload stage
+            dedup.expect_upload(task)
+            await uploader.enqueue(channel_id, message_id, download_path, remote_dir, file_name, file_size)
+            handed_off = True
+        elif download_success:
+            if streamed:
+                dedup.record_remote(task, remote_dir, file_name)
             else:
-                storage.record_file_complete(channel_id, message_id, 'completed')
-                state.queue.task_done()
-                continue
+                dedup.record_local(task, download_path)
+            storage.record_file_complete(channel_id, message_id, 'completed', file_size=file_size)
+        elif retry_class == 'disk':
+            # Not the file's fault: keep its retries and .part file and try again once space is freed
+            diskspace.metrics['enospc'] += 1
+            logger.error(f"[{name}] Out of disk space while downloading {file_name}")
+            retries.schedule(task, 'disk', 1)
+        elif error_msg:
+            status = _record_failure(task, error_msg, retry_class, retry_wait)
+            # Keep the .part file for the next attempt unless retries are exhausted
+            part_path = transfer.part_path_for(download_path)
+            if status and status[0] == 'failed' and os.path.exists(part_path):
+                try: os.remove(part_path)
+                except: pass
+        await state.update_download_activity()
         
-        file_size = 0
+        # Immediately trigger a progress report check on completion
         try:
-            if message.document: file_size = message.document.size
-            elif message.photo: file_size = max((s.size for s in message.photo.sizes if hasattr(s, 'size')), default=0)
+            import tasks
+            asyncio.create_task(tasks.send_progress_report(force=True))
         except: pass
-        
-        # storage.record_file_start is already called in queue_message_for_download
-        download_key = f"{channel_id}_{message_id}"
-        state.active_downloads[download_key] = {
-            'file_name': file_name, 
-            'start_time': time.time(), 
-            'file_size': file_size,
-            'downloaded': 0
-        }
-        
-        logger.info(f"[{name}] Starting download: {chat_title} - {file_name} ({utils.bytes_to_string(file_size)})")
-        
-        download_success = False
-        error_msg = None
-        
-        async def progress_callback(downloaded, total):
-            state.update_active_download(download_key, downloaded)
-            # Optional: trigger quick report if percent jumps significantly? 
-            # For now, let the periodic task handle it or completion.
-        
-        try:
-            await state.update_download_activity()
-            await asyncio.wait_for(
-                state.client.download_media(message, download_path, progress_callback=progress_callback), 
-                timeout=config.DOWNLOAD_TIMEOUT
-            )
-            
-            if os.path.exists(download_path):
-                download_success = True
-                logger.info(f"[{name}] Download completed: {file_name}")
-                
-                if config.UPLOAD_FILE_SET:
-                    try:
-                        # Use moveto if OPERATE is move for efficiency on single files
-                        # but keeping current structure for simplicity if user preferred it.
-                        # Optimization: remove redundant os.remove if move succeeded.
-                        args = [
-                            'rclone', config.OPERATE, download_path,
-                            f"{config.DRIVE_NAME}:{config.DRIVE_PATH}/{dirname}/{datetime_dir_name}/",
-                            '--ignore-existing',
-                            '--buffer-size', '16M',
-                            '--quiet'
-                        ]
-                        
-                        proc = await asyncio.wait_for(
-                            asyncio.create_subprocess_exec(*args), 
-                            timeout=config.DOWNLOAD_TIMEOUT
-                        )
-                        await proc.wait()
-                        
-                        if proc.returncode == 0:
-                            logger.info(f"[{name}] Upload completed: {file_name}")
-                            # If it was move, file is already gone. If copy, we might want to keep it or delete it.
-                            # Current logic suggests we want to delete it after upload regardless.
-                            if config.OPERATE != 'move' and os.path.exists(download_path):
-                                try: os.remove(download_path)
-                                except: pass
-                        else:
-                            logger.error(f"[{name}] Upload failed with code {proc.returncode} for {file_name}")
-                    except Exception as e:
-                        logger.error(f'Upload error for {file_name}: {e}')
-            else:
-                error_msg = "File not found after download"
-        except asyncio.TimeoutError:
-            error_msg = "Download timeout"
-            if file_status and file_status[2] < config.MAX_RETRIES - 1:
-                await state.queue.put((message, chat_title, entity, file_name))
-        except errors.FloodWaitError as e:
-            error_msg = f"FloodWait: {e.seconds}s"
-            await asyncio.sleep(min(e.seconds, 300))
-            await state.queue.put((message, chat_title, entity, file_name))
-        except (errors.FileReferenceExpiredError, errors.FileReferenceInvalidError):
-            error_msg = "File reference expired"
-            try:
-                async for new_message in state.client.iter_messages(entity=entity, offset_id=message_id - 1, reverse=True, limit=1):
-                    await state.queue.put((new_message, chat_title, entity, file_name))
-                    break
-            except: pass
-        except Exception as e:
-            error_msg = str(e)
-        finally:
-            if download_key in state.active_downloads:
-                del state.active_downloads[download_key]
-            if download_success:
-                storage.record_file_complete(channel_id, message_id, 'completed')
-            elif error_msg:
-                storage.record_file_complete(channel_id, message_id, 'failed', error_msg)
-            if not download_success and os.path.exists(download_path):
-                try: os.remove(download_path)
-                except: pass
-            await state.update_download_activity()
-            
-            # Immediately trigger a progress report check on completion
-            try:
-                import tasks
-                asyncio.create_task(tasks.send_progress_report(force=True))
-            except: pass
-            
-            state.queue.task_done()
+    return handed_off
 
 async def resume_downloads(channel_id=None, send_notification=True):
     """Resume downloads from last checkpoint."""
-    if not os.path.exists(config.PROGRESS_DIR):
-        return 0, 'No progress records found' if send_notification else None
-    
     channels_to_resume = []
-    for filename in os.listdir(config.PROGRESS_DIR):
-        if not filename.startswith('channel_') or not filename.endswith('.json'): continue
+    for ch_id in storage.list_channel_ids():
+        if channel_id and ch_id != channel_id: continue
         try:
-            progress = storage.load_channel_progress(filename[8:-5])
-            ch_id = progress['channel_id']
-            if channel_id and ch_id != channel_id: continue
-            
-            # Cleanup of old paths is no longer possible/needed as we don't store them
-             # We just rely on downloading keys to know what to resume
+            progress = storage.load_channel_progress(ch_id)
             
-            start_msg_id = progress.get('last_message_id', 0)
+            start_msg_id = progress.get('watermark', 0)
             if progress.get('downloading'):
                 start_msg_id = min([int(mid) for mid in progress['downloading'].keys()] + [start_msg_id])
             
             if start_msg_id > 0 or progress.get('downloading'):
                 channels_to_resume.append((ch_id, start_msg_id, progress.get('channel_name', f'Channel {ch_id}')))
         except Exception as e:
-            logger.error(f'Error reading progress for {filename}: {e}')
+            logger.error(f'Error reading progress for channel {ch_id}: {e}')
     
     if not channels_to_resume:
         return 0, 'No channels to resume' if send_notification else None
@@ -293,22 +401,28 @@ async def resume_downloads(channel_id=None, send_notification=True):
     total_added = 0
     for ch_id, start_msg_id, ch_name in channels_to_resume:
         try:
-            entity = await state.client.get_entity(ch_id)
+            entity = await messages.get_entity(ch_id)
             chat_title = entity.title
             progress = storage.load_channel_progress(ch_id)
             downloading_ids = sorted([int(x) for x in progress.get('downloading', {}).keys()])
             
-            for mid in downloading_ids:
-                try:
-                    message = await state.client.get_messages(entity, ids=mid)
-                    if message and message.media:
-                        if await queue_message_for_download(message, entity, chat_title):
-                            total_added += 1
-                except: pass
+            messages.remember_entity(entity)
+            # Journaled and scheduled tasks are replayed without asking Telegram again
+            missing_ids = [
+                mid for mid in downloading_ids
+                if not (state.queue.contains(ch_id, mid) or retries.is_scheduled(ch_id, mid))
+            ]
+            fetched = await asyncio.gather(*(messages.fetch(ch_id, mid) for mid in missing_ids), return_exceptions=True)
+            albums.remember(ch_id, [m for m in fetched if m and not isinstance(m, Exception)])
+            for message in fetched:
+                if isinstance(message, Exception) or not message or not message.media:
+                    continue
+                if await queue_message_for_download(message, entity, chat_title):
+                    total_added += 1
             
             iter_offset = max(0, start_msg_id - 1)
             async for message in state.client.iter_messages(entity, offset_id=iter_offset, reverse=True, limit=config.SCAN_BATCH_SIZE):
-                if not message.media or message.id <= progress['last_message_id'] or message.id in downloading_ids:
+                if not message.media or message.id in downloading_ids or storage.get_file_status(ch_id, message.id):
                     continue
                 if await queue_message_for_download(message, entity, chat_title):
                     total_added += 1
@@ -318,33 +432,3 @@ async def resume_downloads(channel_id=None, send_notification=True):
     result_msg = f'Resumed {len(channels_to_resume)} channels, added {total_added} files to queue'
     logger.info(result_msg)
     return total_added, result_msg
-
-async def process_channel_messages(entity, chat_title, offset_id=0, end_id=None, limit=None):
-    """Scan and process messages from a channel."""
-    queued_count = 0
-    last_id = offset_id
-    scanned_count = 0
-    
-    try:
-        async for message in state.client.iter_messages(entity, offset_id=offset_id, reverse=True, limit=limit):
-            scanned_count += 1
-            if end_id and message.id > end_id:
-                break
-                
-            last_id = max(last_id, message.id)
-            
-            if not message.media:
-                continue
-                
-            # Check if already completed or downloading
-            status = storage.get_file_status(entity.id, message.id)
-            if status and (status[0] == 'completed' or status[2] >= config.MAX_RETRIES):
-                continue
-                
-            if await queue_message_for_download(message, entity, chat_title):
-                queued_count += 1
-                
-    except Exception as e:
-        logger.error(f"Error processing messages for {chat_title}: {e}")
-        
-    return queued_count, last_id, scanned_count
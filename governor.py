@@ -0,0 +1,116 @@
+import time
+import asyncio
+import logging
+from telethon import TelegramClient, errors
+import config
+import state
+
+logger = logging.getLogger('tg_downloader')
+
+# Telegram request types grouped by the limit they count against
+REQUEST_CLASSES = {
+    'GetHistoryRequest': 'history',
+    'SearchRequest': 'history',
+    'GetMessagesRequest': 'history',
+    'GetRepliesRequest': 'history',
+    'GetFileRequest': 'file',
+    'GetCdnFileRequest': 'file',
+    'GetChannelsRequest': 'entity',
+    'GetFullChannelRequest': 'entity',
+    'GetUsersRequest': 'entity',
+    'GetChatsRequest': 'entity',
+    'ResolveUsernameRequest': 'entity',
+    'CheckChatInviteRequest': 'entity',
+}
+
+class TokenBucket:
+    """Token bucket allowing `rate` requests per second with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def take(self):
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+_buckets = {}
+_paused_until = 0
+metrics = {
+    'requests': {},      # request class -> calls made
+    'waited': {},        # request class -> seconds spent waiting for a token or a pause
+    'flood_waits': 0,
+    'flood_wait_seconds': 0,
+}
+
+def _bucket(request_class):
+    if request_class not in _buckets:
+        rate = {
+            'history': config.RATE_LIMIT_HISTORY,
+            'file': config.RATE_LIMIT_FILE,
+            'entity': config.RATE_LIMIT_ENTITY,
+        }.get(request_class, 0)
+        _buckets[request_class] = TokenBucket(rate, rate * 2)
+    return _buckets[request_class]
+
+def classify(request):
+    """Request class ('history', 'file', 'entity' or 'other') a Telegram request counts against."""
+    if isinstance(request, (list, tuple)):
+        request = request[0] if request else None
+    return REQUEST_CLASSES.get(type(request).__name__, 'other')
+
+def pause(seconds):
+    """Hold every governed request for `seconds` (extends, never shortens, a running pause)."""
+    global _paused_until
+    until = time.monotonic() + seconds
+    if until > _paused_until:
+        _paused_until = until
+        logger.warning(f'FloodWait: pausing all Telegram requests for {seconds}s')
+
+def paused_for():
+    """Seconds left in the current global pause."""
+    return max(0, _paused_until - time.monotonic())
+
+async def acquire(request_class):
+    """Wait out any global pause, then take a token for the request class."""
+    started = time.monotonic()
+    while paused_for() > 0:
+        await asyncio.sleep(paused_for())
+    await _bucket(request_class).take()
+    metrics['requests'][request_class] = metrics['requests'].get(request_class, 0) + 1
+    metrics['waited'][request_class] = metrics['waited'].get(request_class, 0) + time.monotonic() - started
+
+def record_flood_wait(seconds, request_class='other'):
+    metrics['flood_waits'] += 1
+    metrics['flood_wait_seconds'] += seconds
+    if request_class == 'file':
+        state.flood_waits += 1
+    pause(seconds)
+
+class GovernedTelegramClient(TelegramClient):
+    """TelegramClient whose every request passes through the shared governor.
+
+    Short FloodWaits (up to FLOOD_SLEEP_THRESHOLD) pause all requests and are retried
+    transparently; longer ones still pause everything and are raised to the caller.
+    """
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        request_class = classify(request)
+        while True:
+            await acquire(request_class)
+            try:
+                return await super()._call(sender, request, ordered=ordered, flood_sleep_threshold=0)
+            except errors.FloodWaitError as e:
+                record_flood_wait(e.seconds, request_class)
+                if e.seconds > config.FLOOD_SLEEP_THRESHOLD:
+                    raise
@@ -3,12 +3,17 @@ import os
 import sys
 import logging
 import config  # Initialize logging and load .env as early as possible
-from telethon import TelegramClient, events
+from telethon import TelegramClient
 import state
 import storage
 import client
 import tasks
 import downloader
+import uploader
+import concurrency
+import governor
+import retries
+import scheduler
 
 logger = logging.getLogger('tg_downloader')
 
@@ -18,10 +23,6 @@ def check_environ():
         logger.error("Essential configuration (API_ID, API_HASH, BOT_TOKEN, ADMIN_ID) is missing!")
         sys.exit(1)
     
-    # Adjust max concurrency if uploading is enabled
-    if config.DRIVE_NAME and config.UPLOAD_FILE_SET:
-        config.MAX_NUM = 1
-    
     if not os.path.exists('.session'):
         os.makedirs('.session')
     
@@ -36,6 +37,7 @@ def check_environ():
             import re
             ids = [int(s) for s in re.split(r'[\s,;]+', config.WHITELIST_STR) if s.isdigit() or (s.startswith('-') and s[1:].isdigit())]
             storage.whitelist = ids
+            storage.refresh_whitelist()
             storage.save_whitelist_to_file(ids)
             state.download_all_chat = True
         else:
@@ -64,6 +66,10 @@ async def shutdown(sig, loop):
     logger.info(f"Cancelling {len(tasks)} outstanding tasks")
     await asyncio.gather(*tasks, return_exceptions=True)
     
+    storage.close_progress()
+    retries.save()
+    await uploader.stop()
+    
     if state.client:
         await state.client.disconnect()
     if state.bot:
@@ -73,21 +79,28 @@ async def shutdown(sig, loop):
     logger.info("Shutdown complete.")
 
 async def main():
-    state.queue = asyncio.Queue()
     check_environ()
+    state.queue = scheduler.DownloadScheduler()
+    if state.queue.qsize():
+        logger.info(f'Replaying {state.queue.qsize()} queued downloads from the queue journal')
+    state.upload_queue = asyncio.Queue()
+    state.download_limiter = concurrency.create_limiter()
+    retries.load()
     
     # Initialize Clients
-    state.client = TelegramClient('.session/telegram_downloader', config.API_ID, config.API_HASH, proxy=config.PROXY)
+    state.client = governor.GovernedTelegramClient('.session/telegram_downloader', config.API_ID, config.API_HASH, proxy=config.PROXY, flood_sleep_threshold=0)
     state.bot = await TelegramClient('.session/telegram_downloader_bot', config.API_ID, config.API_HASH, proxy=config.PROXY).start(bot_token=config.BOT_TOKEN)
     
     await state.client.start()
     
+    if config.UPLOAD_FILE_SET:
+        await uploader.start()
+    
     # Register handlers
     client.register_handlers(state.bot)
     
     if state.download_all_chat:
-        state.client.add_event_handler(client.all_chat_download, events.NewMessage())
-        state.all_chat_listener_registered = True
+        client.register_live_listener()
         logger.info('Auto-download listener registered')
     
     # Start workers
@@ -95,10 +108,19 @@ async def main():
     for i in range(config.MAX_NUM):
         worker_tasks.append(asyncio.create_task(downloader.worker(f'Worker-{i}')))
     
+    if config.UPLOAD_FILE_SET:
+        for i in range(config.UPLOAD_CONCURRENCY):
+            worker_tasks.append(asyncio.create_task(uploader.upload_worker(f'Uploader-{i}')))
+        asyncio.create_task(uploader.batch_flush_task())
+    
     # Start background tasks
     asyncio.create_task(tasks.watch_whitelist_file())
     asyncio.create_task(tasks.periodic_rescan_task())
     asyncio.create_task(tasks.health_check_task())
+    asyncio.create_task(tasks.progress_flush_task())
+    asyncio.create_task(retries.retry_scheduler_task())
+    if config.ADAPTIVE_CONCURRENCY:
+        asyncio.create_task(tasks.concurrency_controller_task())
     
     # Auto resume if enabled
     if config.AUTO_RESUME:
@@ -0,0 +1,120 @@
+import time
+import asyncio
+import logging
+import config
+import state
+import utils
+
+logger = logging.getLogger('tg_downloader')
+
+# Telegram returns at most this many messages per GetMessages call
+FETCH_BATCH_SIZE = 100
+# Upper bound on prefetched messages kept for upcoming tasks
+CACHE_MAX_ITEMS = 2000
+
+_entities = {}  # bare chat id -> (cached_at, entity)
+_lookups = {}  # bare chat id -> in-flight get_entity task
+_pending = {}  # channel_id -> {message_id: [futures]}
+_batch_tasks = {}  # channel_id -> task that will fetch the pending batch
+_cache = {}  # (channel_id, message_id) -> (fetched_at, message) prefetched for queued tasks
+metrics = {'fetches': 0, 'cache_hits': 0, 'api_calls': 0, 'messages_requested': 0, 'entity_lookups': {}}
+
+def remember_entity(entity):
+    """Cache an entity seen while scanning so workers can fetch from its channel without a lookup."""
+    _entities[entity.id] = (time.time(), entity)
+
+def forget_entity(chat_id):
+    """Drop a cached entity, e.g. after the chat was renamed."""
+    _entities.pop(utils.bare_chat_id(chat_id), None)
+
+def _cached_entity(chat_id):
+    """Cached entity for a chat id (bare or marked) if still fresh, without asking Telegram."""
+    cached = _entities.get(utils.bare_chat_id(chat_id))
+    if cached and time.time() - cached[0] < config.ENTITY_CACHE_TTL:
+        return cached[1]
+    return None
+
+def fetch_stats():
+    """Fetch counters plus Telegram requests per fetched message."""
+    served = metrics['fetches']
+    return {**metrics, 'calls_per_message': metrics['api_calls'] / served if served else 0}
+
+async def get_entity(chat_id, source='workers'):
+    """Entity for a chat id (bare or marked), cached for ENTITY_CACHE_TTL; concurrent lookups share a request.
+
+    Telegram lookups are counted per `source` in metrics['entity_lookups'].
+    """
+    entity = _cached_entity(chat_id)
+    if entity is not None:
+        return entity
+    key = utils.bare_chat_id(chat_id)
+    lookup = _lookups.get(key)
+    if lookup is None:
+        metrics['entity_lookups'][source] = metrics['entity_lookups'].get(source, 0) + 1
+        lookup = _lookups[key] = asyncio.ensure_future(state.client.get_entity(chat_id))
+        lookup.add_done_callback(lambda _: _lookups.pop(key, None))
+    entity = await lookup
+    _entities[key] = (time.time(), entity)
+    return entity
+
+async def fetch(channel_id, message_id):
+    """Fetch a fresh Message (None if deleted); concurrent fetches for one channel share a request.
+
+    Messages of upcoming queued tasks in the same channel are fetched along in the same request
+    and served from a short-lived cache, so their file references are fresh when a worker starts.
+    """
+    metrics['fetches'] += 1
+    cached = _cache.pop((channel_id, message_id), None)
+    if cached and time.time() - cached[0] < config.MESSAGE_CACHE_TTL:
+        metrics['cache_hits'] += 1
+        return cached[1]
+    future = asyncio.get_running_loop().create_future()
+    _pending.setdefault(channel_id, {}).setdefault(message_id, []).append(future)
+    if channel_id not in _batch_tasks:
+        _batch_tasks[channel_id] = asyncio.create_task(_fetch_batch(channel_id))
+    return await future
+
+def _prefetch_ids(channel_id, exclude, room):
+    """Ids of upcoming queued tasks in a channel whose messages are worth fetching now."""
+    if room <= 0 or not config.MESSAGE_PREFETCH or state.queue is None:
+        return []
+    ids = []
+    for message_id in state.queue.upcoming(channel_id, config.MESSAGE_PREFETCH + len(exclude)):
+        if message_id not in exclude and (channel_id, message_id) not in _cache:
+            ids.append(message_id)
+    return ids[:room]
+
+def _store(channel_id, message_id, message):
+    if len(_cache) >= CACHE_MAX_ITEMS:
+        # Evict the oldest prefetched message
+        del _cache[next(iter(_cache))]
+    _cache[(channel_id, message_id)] = (time.time(), message)
+
+async def _fetch_batch(channel_id):
+    await asyncio.sleep(config.MESSAGE_FETCH_WINDOW_MS / 1000)
+    waiting = _pending.pop(channel_id)
+    del _batch_tasks[channel_id]
+    ids = list(waiting)
+    # Fill the last request up with upcoming tasks instead of sending it half empty
+    ids += _prefetch_ids(channel_id, waiting, -len(ids) % FETCH_BATCH_SIZE)
+    try:
+        entity = await get_entity(channel_id)
+        for i in range(0, len(ids), FETCH_BATCH_SIZE):
+            chunk = ids[i:i + FETCH_BATCH_SIZE]
+            metrics['api_calls'] += 1
+            metrics['messages_requested'] += len(chunk)
+            fetched = await state.client.get_messages(entity, ids=chunk)
+            for message_id, message in zip(chunk, fetched):
+                if message_id not in waiting:
+                    if message is not None:
+                        _store(channel_id, message_id, message)
+                    continue
+                for future in waiting.pop(message_id):
+                    if not future.done():
+                        future.set_result(message)
+    except Exception as e:
+        logger.error(f'Failed to fetch {len(ids)} messages from channel {channel_id}: {e}')
+        for futures in waiting.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
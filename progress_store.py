@@ -0,0 +1,619 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger('tg_downloader')
+
+def new_channel_summary(channel_id):
+    """Default per-channel summary fields."""
+    return {
+        'channel_id': channel_id,
+        'channel_name': '',
+        'last_message_id': 0,
+        'watermark': 0,
+        'scanned_id': 0,
+        'completed_ranges': [],
+        'completed_count': 0,
+        'failed_count': 0,
+        'pending_count': 0,
+        'completed_bytes': 0
+    }
+
+def _retry_from_value(val):
+    """Extract retry count from a legacy dict or int 'downloading' value."""
+    if isinstance(val, dict):
+        return val.get('retry_count', 0)
+    if isinstance(val, int):
+        return val
+    return 0
+
+class SpilledRanges:
+    """Completed ranges a CompletionIndex moved out of memory, kept exactly in the backend."""
+
+    def __init__(self, backend, channel_id):
+        self.backend = backend
+        self.channel_id = channel_id
+        # Lowest and highest spilled ids, None when nothing is spilled
+        self.floor, self.ceiling = backend.spilled_bounds(channel_id)
+
+    def __contains__(self, message_id):
+        return (self.floor is not None and message_id >= self.floor
+                and self.backend.in_spilled_ranges(self.channel_id, message_id))
+
+    def add(self, ranges):
+        self.backend.add_spilled_ranges(self.channel_id, ranges)
+        self.floor, self.ceiling = self.backend.spilled_bounds(self.channel_id)
+
+    def fold(self, up_to):
+        """Drop the spilled ranges ending at or below `up_to`; returns the highest dropped id or None."""
+        if self.floor is None or self.floor > up_to:
+            return None
+        highest = self.backend.fold_spilled_ranges(self.channel_id, up_to)
+        self.floor, self.ceiling = self.backend.spilled_bounds(self.channel_id)
+        return highest
+
+class CompletionIndex:
+    """Finished message ids of one channel: a watermark, sorted ranges finished above it, and failures.
+
+    `scanned` is the highest id up to which a scan has recorded every message, so no id at or
+    below it can still be unqueued. The watermark only moves past ranges below both `scanned` and
+    the lowest in-flight id. Beyond max_ranges, the highest ranges are moved to `spill` so the
+    serialized size stays bounded without ever marking an unfinished id as done.
+    """
+
+    def __init__(self, watermark=0, ranges=(), failed=(), max_ranges=1000, scanned=0, spill=None):
+        self.watermark = watermark
+        self.scanned = max(scanned, watermark)
+        self.starts = []
+        self.ends = []
+        self.failed = set(failed)
+        self.max_ranges = max_ranges
+        self.spill = spill
+        for start, end in sorted(ranges):
+            if end <= self.watermark:
+                continue
+            start = max(start, self.watermark + 1)
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __contains__(self, message_id):
+        if message_id <= self.watermark:
+            return True
+        i = bisect_right(self.starts, message_id)
+        if i > 0 and self.ends[i - 1] >= message_id:
+            return True
+        return self.spill is not None and message_id in self.spill
+
+    def add(self, message_id):
+        """Mark an id as finished; returns False if it already was."""
+        if message_id in self:
+            return False
+        i = bisect_right(self.starts, message_id)
+        merge_left = i > 0 and self.ends[i - 1] == message_id - 1
+        merge_right = i < len(self.starts) and self.starts[i] == message_id + 1
+        if merge_left and merge_right:
+            self.ends[i - 1] = self.ends.pop(i)
+            self.starts.pop(i)
+        elif merge_left:
+            self.ends[i - 1] = message_id
+        elif merge_right:
+            self.starts[i] = message_id
+        else:
+            self.starts.insert(i, message_id)
+            self.ends.insert(i, message_id)
+        return True
+
+    def advance(self, min_pending=None):
+        """Fold ranges that are fully scanned and below the lowest in-flight id into the watermark."""
+        bound = self.scanned if min_pending is None else min(self.scanned, min_pending - 1)
+        limit = bisect_right(self.ends, bound)
+        highest = self.ends[limit - 1] if limit > 0 else self.watermark
+        if self.spill is not None:
+            highest = max(highest, self.spill.fold(bound) or 0)
+        advanced = highest > self.watermark
+        self.watermark = max(self.watermark, highest)
+        del self.starts[:limit]
+        del self.ends[:limit]
+        self._compact()
+        return advanced
+
+    def _compact(self):
+        """Move the highest ranges to the spill store once more than max_ranges are held in memory."""
+        if self.spill is None or len(self.starts) <= self.max_ranges:
+            return
+        # Spill down to half the limit so a busy channel does not spill on every completion
+        keep = self.max_ranges // 2
+        self.spill.add(list(zip(self.starts[keep:], self.ends[keep:])))
+        del self.starts[keep:]
+        del self.ends[keep:]
+
+    def highest(self):
+        """Highest finished id."""
+        highest = self.ends[-1] if self.ends else self.watermark
+        if self.spill is not None and self.spill.ceiling is not None:
+            highest = max(highest, self.spill.ceiling)
+        return highest
+
+    def to_ranges(self):
+        return [[s, e] for s, e in zip(self.starts, self.ends)]
+
+class JsonProgressBackend:
+    """Legacy backend: one JSON file per channel, cached in memory and written back on flush."""
+    name = 'json'
+
+    def __init__(self, progress_dir):
+        self.progress_dir = progress_dir
+        self._cache = {}  # channel_id -> progress dict
+        self._dirty = set()
+        self.write_count = 0
+        self.flush_count = 0
+
+    def get_progress_file(self, channel_id):
+        return os.path.join(self.progress_dir, f'channel_{channel_id}.json')
+
+    def _read(self, channel_id):
+        progress_file = self.get_progress_file(channel_id)
+        progress = None
+        if os.path.exists(progress_file):
+            try:
+                with open(progress_file, 'r', encoding='utf-8') as f:
+                    progress = json.load(f)
+            except Exception as e:
+                logger.error(f'Error loading progress file: {e}')
+        if progress is None:
+            progress = new_channel_summary(channel_id)
+        progress.setdefault('downloading', {})
+        # Legacy files treated everything up to last_message_id as done
+        progress.setdefault('watermark', progress.get('last_message_id', 0))
+        progress.setdefault('scanned_id', progress['watermark'])
+        progress.setdefault('completed_ranges', [])
+        progress.setdefault('spilled_ranges', [])
+        progress['failed_ids'] = set(progress.get('failed_ids', []))
+        if 'pending_count' not in progress:
+            # Files from before incremental counters: derive them once from the id lists
+            progress['pending_count'] = len(progress['downloading'])
+            progress['failed_count'] = len(progress['failed_ids'])
+        progress.setdefault('completed_bytes', 0)
+        return progress
+
+    def _write(self, channel_id, progress):
+        """Write a channel file atomically (temp file + os.replace)."""
+        progress_file = self.get_progress_file(channel_id)
+        tmp_path = f'{progress_file}.tmp.{os.getpid()}'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({**progress, 'failed_ids': sorted(progress['failed_ids'])}, f, ensure_ascii=False)
+                f.flush()
+                try:
+                    os.fsync(f.fileno())
+                except Exception:
+                    pass
+            os.replace(tmp_path, progress_file)
+            self.flush_count += 1
+            return True
+        except Exception as e:
+            logger.error(f'Error saving progress file: {e}')
+            if os.path.exists(tmp_path):
+                try: os.remove(tmp_path)
+                except: pass
+            return False
+
+    @contextmanager
+    def session(self, channel_id):
+        yield
+
+    def _open(self, channel_id):
+        progress = self._cache.get(channel_id)
+        if progress is None:
+            progress = self._cache[channel_id] = self._read(channel_id)
+        return progress
+
+    def _commit(self, channel_id, progress):
+        progress['last_update'] = datetime.now().isoformat()
+        self._dirty.add(channel_id)
+        self.write_count += 1
+
+    def channel_ids(self):
+        ids = set(self._cache)
+        if not os.path.exists(self.progress_dir):
+            return sorted(ids)
+        for filename in os.listdir(self.progress_dir):
+            if not filename.startswith('channel_') or not filename.endswith('.json'):
+                continue
+            try:
+                ids.add(int(filename[8:-5]))
+            except ValueError:
+                continue
+        return sorted(ids)
+
+    def get_channel(self, channel_id):
+        progress = self._open(channel_id)
+        summary = new_channel_summary(channel_id)
+        for key in summary:
+            if key in progress and key != 'channel_id':
+                summary[key] = progress[key]
+        return summary
+
+    def update_channel(self, channel_id, **fields):
+        progress = self._open(channel_id)
+        progress.update(fields)
+        self._commit(channel_id, progress)
+
+    def get_message(self, channel_id, message_id):
+        progress = self._open(channel_id)
+        val = progress['downloading'].get(str(message_id))
+        if val is not None:
+            return ('downloading', _retry_from_value(val))
+        if message_id in progress['failed_ids']:
+            return ('failed', 0)
+        return None
+
+    def get_messages(self, channel_id, message_ids):
+        entries = {}
+        for message_id in message_ids:
+            entry = self.get_message(channel_id, message_id)
+            if entry is not None:
+                entries[message_id] = entry
+        return entries
+
+    def set_message(self, channel_id, message_id, status, retry_count=0):
+        progress = self._open(channel_id)
+        msg_id_str = str(message_id)
+        if status == 'downloading':
+            offset = self.get_offset(channel_id, message_id)
+            progress['downloading'][msg_id_str] = {'retry_count': retry_count, 'resume_offset': offset} if offset else retry_count
+            progress['failed_ids'].discard(message_id)
+        else:
+            progress['downloading'].pop(msg_id_str, None)
+            progress['failed_ids'].add(message_id)
+        self._commit(channel_id, progress)
+
+    def get_offset(self, channel_id, message_id):
+        val = self._open(channel_id)['downloading'].get(str(message_id))
+        return val.get('resume_offset', 0) if isinstance(val, dict) else 0
+
+    def set_offset(self, channel_id, message_id, offset):
+        progress = self._open(channel_id)
+        msg_id_str = str(message_id)
+        if msg_id_str in progress['downloading']:
+            retry_count = _retry_from_value(progress['downloading'][msg_id_str])
+            progress['downloading'][msg_id_str] = {'retry_count': retry_count, 'resume_offset': offset} if offset else retry_count
+            self._commit(channel_id, progress)
+
+    def delete_message(self, channel_id, message_id):
+        progress = self._open(channel_id)
+        progress['downloading'].pop(str(message_id), None)
+        progress['failed_ids'].discard(message_id)
+        self._commit(channel_id, progress)
+
+    def list_messages(self, channel_id, status):
+        progress = self._open(channel_id)
+        if status == 'downloading':
+            return sorted((int(k), _retry_from_value(v)) for k, v in progress['downloading'].items())
+        return sorted((int(mid), 0) for mid in progress['failed_ids'])
+
+    def min_pending(self, channel_id):
+        progress = self._open(channel_id)
+        return min((int(k) for k in progress['downloading']), default=None)
+
+    def count_messages(self, channel_id, status):
+        progress = self._open(channel_id)
+        if status == 'downloading':
+            return len(progress['downloading'])
+        return len(progress['failed_ids'])
+
+    def spilled_bounds(self, channel_id):
+        spilled = self._open(channel_id)['spilled_ranges']
+        return (spilled[0][0], spilled[-1][1]) if spilled else (None, None)
+
+    def in_spilled_ranges(self, channel_id, message_id):
+        spilled = self._open(channel_id)['spilled_ranges']
+        i = bisect_right(spilled, [message_id, float('inf')])
+        return i > 0 and spilled[i - 1][1] >= message_id
+
+    def add_spilled_ranges(self, channel_id, ranges):
+        progress = self._open(channel_id)
+        progress['spilled_ranges'] = sorted(progress['spilled_ranges'] + [list(r) for r in ranges])
+        self._commit(channel_id, progress)
+
+    def fold_spilled_ranges(self, channel_id, up_to):
+        progress = self._open(channel_id)
+        spilled = progress['spilled_ranges']
+        folded = [r for r in spilled if r[1] <= up_to]
+        if not folded:
+            return None
+        progress['spilled_ranges'] = [r for r in spilled if r[1] > up_to]
+        self._commit(channel_id, progress)
+        return folded[-1][1]
+
+    def clear_messages(self, channel_id):
+        progress = self._open(channel_id)
+        progress['downloading'] = {}
+        progress['failed_ids'] = set()
+        self._commit(channel_id, progress)
+
+    def flush(self):
+        """Write every dirty channel; failed writes stay dirty for the next flush."""
+        for channel_id in list(self._dirty):
+            if self._write(channel_id, self._cache[channel_id]):
+                self._dirty.discard(channel_id)
+
+    def close(self):
+        self.flush()
+
+class SqliteProgressBackend:
+    """SQLite (WAL) backend with indexed per-message rows and batched commits."""
+    name = 'sqlite'
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS channels (
+            channel_id INTEGER PRIMARY KEY,
+            channel_name TEXT NOT NULL DEFAULT '',
+            last_message_id INTEGER NOT NULL DEFAULT 0,
+            completed_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            watermark INTEGER,
+            scanned_id INTEGER,
+            completed_ranges TEXT,
+            pending_count INTEGER,
+            completed_bytes INTEGER NOT NULL DEFAULT 0,
+            last_update TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS messages (
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            retry_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (channel_id, message_id)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_messages_status ON messages (channel_id, status, message_id)',
+        '''CREATE TABLE IF NOT EXISTS spilled_ranges (
+            channel_id INTEGER NOT NULL,
+            start_id INTEGER NOT NULL,
+            end_id INTEGER NOT NULL,
+            PRIMARY KEY (channel_id, start_id)
+        ) WITHOUT ROWID''',
+    )
+    # Columns added after the first schema version
+    ADDED_COLUMNS = (
+        ('channels', 'watermark', 'INTEGER'),
+        ('channels', 'completed_ranges', 'TEXT'),
+        ('channels', 'pending_count', 'INTEGER'),
+        ('channels', 'completed_bytes', 'INTEGER NOT NULL DEFAULT 0'),
+        ('channels', 'scanned_id', 'INTEGER'),
+        ('messages', 'resume_offset', 'INTEGER NOT NULL DEFAULT 0'),
+    )
+
+    def __init__(self, db_path, commit_batch=500, commit_interval=2):
+        self.db_path = db_path
+        self.commit_batch = commit_batch
+        self.commit_interval = commit_interval
+        self._pending_writes = 0
+        self._tx_started = None
+        self.write_count = 0
+        self.flush_count = 0
+        self.conn = sqlite3.connect(db_path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for stmt in self.SCHEMA:
+            self.conn.execute(stmt)
+        for table, column, decl in self.ADDED_COLUMNS:
+            columns = [row[1] for row in self.conn.execute(f'PRAGMA table_info({table})')]
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+        self.conn.execute('UPDATE channels SET watermark = last_message_id WHERE watermark IS NULL')
+        self.conn.execute('UPDATE channels SET scanned_id = watermark WHERE scanned_id IS NULL')
+        # Rows from before incremental counters: derive them once from the message rows
+        self.conn.execute(
+            "UPDATE channels SET "
+            "pending_count = (SELECT COUNT(*) FROM messages m WHERE m.channel_id = channels.channel_id AND m.status = 'downloading'), "
+            "failed_count = (SELECT COUNT(*) FROM messages m WHERE m.channel_id = channels.channel_id AND m.status = 'failed') "
+            "WHERE pending_count IS NULL"
+        )
+
+    @contextmanager
+    def session(self, channel_id):
+        yield
+        self._maybe_commit()
+
+    def _write(self, sql, params=()):
+        if self._tx_started is None:
+            self.conn.execute('BEGIN')
+            self._tx_started = time.monotonic()
+        self.conn.execute(sql, params)
+        self._pending_writes += 1
+        self.write_count += 1
+
+    def _maybe_commit(self):
+        if self._tx_started is None:
+            return
+        if (self._pending_writes >= self.commit_batch
+                or time.monotonic() - self._tx_started >= self.commit_interval):
+            self.flush()
+
+    def _ensure_channel(self, channel_id):
+        self._write('INSERT OR IGNORE INTO channels (channel_id, pending_count) VALUES (?, 0)', (channel_id,))
+
+    def channel_ids(self):
+        return [row[0] for row in self.conn.execute('SELECT channel_id FROM channels ORDER BY channel_id')]
+
+    def get_channel(self, channel_id):
+        summary = new_channel_summary(channel_id)
+        row = self.conn.execute(
+            'SELECT channel_name, last_message_id, watermark, scanned_id, completed_ranges, completed_count, '
+            'failed_count, pending_count, completed_bytes FROM channels WHERE channel_id = ?',
+            (channel_id,)
+        ).fetchone()
+        if row:
+            (summary['channel_name'], summary['last_message_id'], watermark, scanned_id, ranges,
+             summary['completed_count'], summary['failed_count'], pending_count, summary['completed_bytes']) = row
+            summary['watermark'] = watermark or 0
+            summary['scanned_id'] = scanned_id or 0
+            summary['pending_count'] = pending_count or 0
+            summary['completed_ranges'] = json.loads(ranges) if ranges else []
+        return summary
+
+    def update_channel(self, channel_id, **fields):
+        self._ensure_channel(channel_id)
+        fields['last_update'] = datetime.now().isoformat()
+        if 'completed_ranges' in fields:
+            fields['completed_ranges'] = json.dumps(fields['completed_ranges'], separators=(',', ':'))
+        columns = ', '.join(f'{k} = ?' for k in fields)
+        self._write(f'UPDATE channels SET {columns} WHERE channel_id = ?', (*fields.values(), channel_id))
+
+    def get_message(self, channel_id, message_id):
+        row = self.conn.execute(
+            'SELECT status, retry_count FROM messages WHERE channel_id = ? AND message_id = ?',
+            (channel_id, message_id)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def get_messages(self, channel_id, message_ids):
+        message_ids = list(message_ids)
+        entries = {}
+        # Stay well below SQLite's bound-parameter limit
+        for i in range(0, len(message_ids), 500):
+            chunk = message_ids[i:i + 500]
+            rows = self.conn.execute(
+                f'SELECT message_id, status, retry_count FROM messages WHERE channel_id = ? '
+                f'AND message_id IN ({",".join("?" * len(chunk))})',
+                (channel_id, *chunk)
+            )
+            for message_id, status, retry_count in rows:
+                entries[message_id] = (status, retry_count)
+        return entries
+
+    def set_message(self, channel_id, message_id, status, retry_count=0):
+        self._ensure_channel(channel_id)
+        self._write(
+            'INSERT INTO messages (channel_id, message_id, status, retry_count) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (channel_id, message_id) DO UPDATE SET status = excluded.status, retry_count = excluded.retry_count, '
+            "resume_offset = CASE WHEN excluded.status = 'downloading' THEN resume_offset ELSE 0 END",
+            (channel_id, message_id, status, retry_count)
+        )
+
+    def get_offset(self, channel_id, message_id):
+        row = self.conn.execute(
+            "SELECT resume_offset FROM messages WHERE channel_id = ? AND message_id = ? AND status = 'downloading'",
+            (channel_id, message_id)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def set_offset(self, channel_id, message_id, offset):
+        self._write(
+            "UPDATE messages SET resume_offset = ? WHERE channel_id = ? AND message_id = ? AND status = 'downloading'",
+            (offset, channel_id, message_id)
+        )
+
+    def delete_message(self, channel_id, message_id):
+        self._write('DELETE FROM messages WHERE channel_id = ? AND message_id = ?', (channel_id, message_id))
+
+    def list_messages(self, channel_id, status):
+        return [tuple(row) for row in self.conn.execute(
+            'SELECT message_id, retry_count FROM messages WHERE channel_id = ? AND status = ? ORDER BY message_id',
+            (channel_id, status)
+        )]
+
+    def min_pending(self, channel_id):
+        return self.conn.execute(
+            "SELECT MIN(message_id) FROM messages WHERE channel_id = ? AND status = 'downloading'", (channel_id,)
+        ).fetchone()[0]
+
+    def count_messages(self, channel_id, status):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM messages WHERE channel_id = ? AND status = ?', (channel_id, status)
+        ).fetchone()[0]
+
+    def spilled_bounds(self, channel_id):
+        return tuple(self.conn.execute(
+            'SELECT MIN(start_id), MAX(end_id) FROM spilled_ranges WHERE channel_id = ?', (channel_id,)
+        ).fetchone())
+
+    def in_spilled_ranges(self, channel_id, message_id):
+        row = self.conn.execute(
+            'SELECT end_id FROM spilled_ranges WHERE channel_id = ? AND start_id <= ? ORDER BY start_id DESC LIMIT 1',
+            (channel_id, message_id)
+        ).fetchone()
+        return row is not None and row[0] >= message_id
+
+    def add_spilled_ranges(self, channel_id, ranges):
+        for start, end in ranges:
+            self._write('INSERT INTO spilled_ranges (channel_id, start_id, end_id) VALUES (?, ?, ?)', (channel_id, start, end))
+
+    def fold_spilled_ranges(self, channel_id, up_to):
+        # The start_id bound lets the primary key narrow the scan; end_id decides which ranges fold
+        highest = self.conn.execute(
+            'SELECT MAX(end_id) FROM spilled_ranges WHERE channel_id = ? AND start_id <= ? AND end_id <= ?',
+            (channel_id, up_to, up_to)
+        ).fetchone()[0]
+        if highest is not None:
+            self._write('DELETE FROM spilled_ranges WHERE channel_id = ? AND start_id <= ? AND end_id <= ?', (channel_id, up_to, up_to))
+        return highest
+
+    def clear_messages(self, channel_id):
+        self._write('DELETE FROM messages WHERE channel_id = ?', (channel_id,))
+
+    def flush(self):
+        """Commit the open batch transaction, if any."""
+        if self._tx_started is None:
+            return
+        try:
+            self.conn.execute('COMMIT')
+            self.flush_count += 1
+        except Exception as e:
+            logger.error(f'Error committing progress database: {e}')
+        self._tx_started = None
+        self._pending_writes = 0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def migrate_from_json(self, progress_dir):
+        """One-shot import of legacy channel_<id>.json files; imported files are renamed to *.migrated."""
+        legacy = JsonProgressBackend(progress_dir)
+        channel_ids = legacy.channel_ids()
+        if not channel_ids:
+            return 0
+        migrated = 0
+        for channel_id in channel_ids:
+            progress_file = legacy.get_progress_file(channel_id)
+            try:
+                progress = legacy._read(channel_id)
+                summary = legacy.get_channel(channel_id)
+                summary.pop('channel_id')
+                self.update_channel(channel_id, **summary)
+                for mid, val in progress['downloading'].items():
+                    self.set_message(channel_id, int(mid), 'downloading', _retry_from_value(val))
+                    if isinstance(val, dict) and val.get('resume_offset'):
+                        self.set_offset(channel_id, int(mid), val['resume_offset'])
+                for mid in sorted(progress['failed_ids']):
+                    if str(mid) not in progress['downloading']:
+                        self.set_message(channel_id, int(mid), 'failed', 0)
+                self.add_spilled_ranges(channel_id, progress['spilled_ranges'])
+                self.flush()
+                os.replace(progress_file, progress_file + '.migrated')
+                migrated += 1
+            except Exception as e:
+                logger.error(f'Error migrating {progress_file}: {e}')
+        self.flush()
+        logger.info(f'Migrated {migrated} JSON progress files into {self.db_path}')
+        return migrated
+
+def create_backend(kind, progress_dir, db_path, commit_batch=500, commit_interval=2):
+    """Create the configured progress backend ('sqlite' or 'json')."""
+    if kind == 'json':
+        return JsonProgressBackend(progress_dir)
+    if kind != 'sqlite':
+        logger.warning(f'Unknown PROGRESS_BACKEND {kind!r}, using sqlite')
+    backend = SqliteProgressBackend(db_path, commit_batch, commit_interval)
+    backend.migrate_from_json(progress_dir)
+    return backend
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import heapq
+import random
+import asyncio
+import logging
+import config
+import state
+import scheduler
+
+logger = logging.getLogger('tg_downloader')
+
+# Base delay (seconds) before the first retry, per error class; doubles with each attempt
+BACKOFF_BASE = {
+    'timeout': 30,
+    'reference': 0,  # workers fetch the message again before every attempt
+    'floodwait': 0,  # the server-imposed wait is used instead
+    'stall': 10,  # resumes from the .part file on a fresh connection
+    'disk': 60,  # out of space; does not count against MAX_RETRIES
+    'upload': 60,  # upload stage only, counted against UPLOAD_MAX_RETRIES
+    'error': 60,
+}
+
+_heap = []  # (due, seq, (channel_id, message_id)) ordered by due time
+_entries = {}  # (channel_id, message_id) -> scheduled retry
+_seq = 0
+_dirty = False
+
+def _retry_file():
+    return os.path.join(config.PROGRESS_DIR, 'retries.json')
+
+def backoff(error_class, attempt, wait=0):
+    """Delay before the next attempt: exponential per error class with +-20% jitter, never below `wait`."""
+    delay = BACKOFF_BASE.get(error_class, BACKOFF_BASE['error']) * 2 ** max(0, attempt - 1)
+    delay = min(delay, config.RETRY_MAX_DELAY) * random.uniform(0.8, 1.2)
+    return max(delay, wait * random.uniform(1.0, 1.2))
+
+def schedule(task, error_class, attempt, wait=0):
+    """Hold a failed DownloadTask until its backoff has passed; `wait` is a server-imposed minimum (FloodWait)."""
+    global _seq, _dirty
+    key = (task.channel_id, task.message_id)
+    due = time.time() + backoff(error_class, attempt, wait)
+    _entries[key] = {'task': task, 'error_class': error_class, 'due': due}
+    _seq += 1
+    heapq.heappush(_heap, (due, _seq, key))
+    _dirty = True
+    logger.info(f'Retrying {task.file_name} ({error_class}) in {due - time.time():.0f}s')
+
+def is_scheduled(channel_id, message_id):
+    return (channel_id, message_id) in _entries
+
+def pending_count():
+    return len(_entries)
+
+def next_due():
+    """Seconds until the next retry is due, or None."""
+    return max(0, _heap[0][0] - time.time()) if _heap else None
+
+def _pop_due():
+    global _dirty
+    due_entries = []
+    now = time.time()
+    while _heap and _heap[0][0] <= now:
+        due, _, key = heapq.heappop(_heap)
+        entry = _entries.get(key)
+        # Skip heap records superseded by a later schedule() of the same message
+        if entry and entry['due'] == due:
+            due_entries.append(_entries.pop(key))
+            _dirty = True
+    return due_entries
+
+async def _release(entries):
+    """Put due retries back on the download queue; workers fetch their messages fresh."""
+    for entry in entries:
+        entry['task'].queued_at = time.time()
+        await state.queue.put(entry['task'])
+
+def save():
+    """Persist scheduled retries atomically."""
+    global _dirty
+    if not _dirty:
+        return
+    records = [{**e, 'task': e['task'].to_record()} for e in _entries.values()]
+    tmp_path = f'{_retry_file()}.tmp.{os.getpid()}'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(records, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, _retry_file())
+        _dirty = False
+    except Exception as e:
+        logger.error(f'Failed to save retry schedule: {e}')
+
+def load():
+    """Restore retries scheduled before the last shutdown."""
+    global _seq
+    if not os.path.exists(_retry_file()):
+        return 0
+    try:
+        with open(_retry_file(), 'r', encoding='utf-8') as f:
+            records = json.load(f)
+    except Exception as e:
+        logger.error(f'Failed to load retry schedule: {e}')
+        return 0
+    for record in records:
+        if 'task' not in record:
+            continue  # entries from before task records; resume finds these files again
+        task = scheduler.DownloadTask.from_record(record['task'])
+        key = (task.channel_id, task.message_id)
+        _entries[key] = {**record, 'task': task}
+        _seq += 1
+        heapq.heappush(_heap, (record['due'], _seq, key))
+    logger.info(f'Restored {len(records)} scheduled retries')
+    return len(records)
+
+async def retry_scheduler_task():
+    """Release retries into the download queue as they become due."""
+    while True:
+        wait = next_due()
+        await asyncio.sleep(1 if wait is None else min(max(wait, 0.1), 1))
+        try:
+            due_entries = _pop_due()
+            if due_entries:
+                await _release(due_entries)
+            save()
+        except Exception as e:
+            logger.error(f'Retry scheduler error: {e}')
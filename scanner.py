@@ -0,0 +1,155 @@
+import time
+import asyncio
+import logging
+from telethon.tl import types
+import config
+import state
+import storage
+import albums
+import downloader
+import messages
+
+logger = logging.getLogger('tg_downloader')
+
+# Messages handled together: one history request returns up to 100
+PAGE_SIZE = 100
+# Ranges smaller than this many message ids are not split further
+MIN_RANGE_IDS = 2000
+
+# SCAN_MEDIA_FILTERS names -> server-side search filters
+MEDIA_FILTERS = {
+    'photo': types.InputMessagesFilterPhotos,
+    'video': types.InputMessagesFilterVideo,
+    'photo_video': types.InputMessagesFilterPhotoVideo,
+    'document': types.InputMessagesFilterDocument,
+    'music': types.InputMessagesFilterMusic,
+    'voice': types.InputMessagesFilterVoice,
+    'round': types.InputMessagesFilterRoundVideo,
+    'gif': types.InputMessagesFilterGif,
+}
+
+metrics = {'scanned': 0, 'seconds': 0.0, 'last': None}
+
+def media_filters():
+    """Server-side filters from SCAN_MEDIA_FILTERS, or [None] to walk the plain history."""
+    names = config.SCAN_MEDIA_FILTERS.split()
+    unknown = [n for n in names if n not in MEDIA_FILTERS]
+    if unknown:
+        logger.warning(f'Ignoring unknown SCAN_MEDIA_FILTERS: {unknown}')
+    return [MEDIA_FILTERS[n] for n in names if n in MEDIA_FILTERS] or [None]
+
+def partition(start_id, end_id, parts):
+    """Split message ids (start_id, end_id] into up to `parts` (offset_id, max_id) ranges."""
+    span = end_id - start_id
+    if span <= 0:
+        return []
+    parts = max(1, min(parts, span // MIN_RANGE_IDS))
+    step = -(-span // parts)
+    return [(lo, min(lo + step, end_id)) for lo in range(start_id, end_id, step)]
+
+async def _process_page(entity, chat_title, page, filtered=False):
+    """Queue the downloadable messages of one page; returns how many were queued.
+
+    Statuses are read and download starts recorded once per page rather than once per message,
+    and album captions come from the page itself where it holds the whole album.
+    """
+    if filtered:
+        # A filtered page skips other media types, so its albums may be missing members
+        albums.remember(entity.id, page)
+    else:
+        albums.remember_page(entity.id, page)
+    page = [message for message in page if message.media]
+    if not page:
+        return 0
+    statuses = storage.get_file_statuses(entity.id, [message.id for message in page])
+    tasks = []
+    for message in page:
+        status = statuses[message.id]
+        if status and (status[0] == 'completed' or status[2] >= config.MAX_RETRIES):
+            continue
+        task = await downloader.prepare_task(message, entity, chat_title)
+        if task is not None:
+            tasks.append(task)
+    if not tasks:
+        return 0
+    storage.record_files_started(entity.id, chat_title, [task.message_id for task in tasks])
+    messages.remember_entity(entity)
+    queued = 0
+    for task in tasks:
+        if await state.queue.put(task):
+            queued += 1
+    return queued
+
+async def scan_range(entity, chat_title, offset_id=0, max_id=None, limit=None, media_filter=None, on_progress=None):
+    """Scan messages after `offset_id` (up to `max_id`) page by page; returns (queued, last_id, scanned).
+
+    `on_progress(message_id)` is called once every message up to `message_id` has been recorded.
+    """
+    queued, last_id, scanned = 0, offset_id, 0
+    page = []
+    kwargs = {'offset_id': offset_id, 'reverse': True, 'limit': limit}
+    if max_id:
+        kwargs['max_id'] = max_id + 1
+    if media_filter:
+        kwargs['filter'] = media_filter
+    try:
+        async for message in state.client.iter_messages(entity, **kwargs):
+            if max_id and message.id > max_id:
+                break
+            scanned += 1
+            last_id = max(last_id, message.id)
+            page.append(message)
+            if len(page) >= PAGE_SIZE:
+                queued += await _process_page(entity, chat_title, page, filtered=bool(media_filter))
+                page = []
+                if on_progress:
+                    on_progress(last_id)
+        queued += await _process_page(entity, chat_title, page, filtered=bool(media_filter))
+        if on_progress:
+            # A bounded range is covered to its end; an open one only up to the last message seen
+            on_progress(max_id if max_id and not (limit and scanned >= limit) else last_id)
+    except Exception as e:
+        logger.error(f"Error processing messages for {chat_title}: {e}")
+    return queued, last_id, scanned
+
+async def scan_channel(entity, chat_title, start_id=0, end_id=None):
+    """Backfill scan of ids (start_id, end_id] as concurrent ranges; returns (queued, last_id, scanned)."""
+    started = time.time()
+    if end_id is None:
+        latest = await state.client.get_messages(entity, limit=1)
+        end_id = latest[0].id if latest else start_id
+    ranges = partition(start_id, end_id, config.SCAN_PARALLELISM)
+    filters = media_filters()
+    reached = [[lo] * len(filters) for lo, _ in ranges]  # per range and filter: recorded up to this id
+
+    def progress(i, j):
+        def on_progress(up_to):
+            reached[i][j] = max(reached[i][j], up_to)
+            # Ranges finish out of order; only the prefix before the first unfinished one counts as scanned
+            prefix = start_id
+            for (_, hi), positions in zip(ranges, reached):
+                prefix = min(positions)
+                if prefix < hi:
+                    break
+            storage.record_scanned(entity.id, start_id, prefix)
+        return on_progress
+
+    # A filtered scan never sees the media types it skips, so only a plain history walk counts as scanned
+    tracked = filters == [None]
+    results = await asyncio.gather(*(
+        scan_range(entity, chat_title, lo, hi, media_filter=f() if f else None,
+                   on_progress=progress(i, j) if tracked else None)
+        for i, (lo, hi) in enumerate(ranges) for j, f in enumerate(filters)
+    ))
+    queued = sum(r[0] for r in results)
+    last_id = max([start_id] + [r[1] for r in results])
+    scanned = sum(r[2] for r in results)
+    elapsed = time.time() - started
+    metrics['scanned'] += scanned
+    metrics['seconds'] += elapsed
+    metrics['last'] = {
+        'channel': chat_title, 'scanned': scanned, 'queued': queued, 'ranges': len(ranges),
+        'rate': scanned / elapsed if elapsed > 0 else 0
+    }
+    logger.info(f'Scanned {scanned} messages of {chat_title} in {len(ranges)} ranges ({metrics["last"]["rate"]:.0f} msg/s), queued {queued}')
+    return queued, last_id, scanned
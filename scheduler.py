@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import heapq
+import sqlite3
+import asyncio
+from collections import deque
+import config
+
+# Lanes in strict priority order: new posts from listened chats before manual/backfill work
+LANES = ('live', 'backfill')
+# Minimum number of tasks read from the journal into memory at once
+LOAD_BATCH = 100
+
+class DownloadTask:
+    """Compact record of a queued download; the Message itself is fetched again right before downloading."""
+
+    __slots__ = ('channel_id', 'message_id', 'chat_title', 'file_name', 'size', 'dc_id', 'date', 'mime', 'queued_at', 'content_id')
+
+    def __init__(self, channel_id, message_id, chat_title, file_name, size=0, dc_id=None, date=0, mime=None, queued_at=None, content_id=None):
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.chat_title = chat_title
+        self.file_name = file_name
+        self.size = size
+        self.dc_id = dc_id
+        self.date = date
+        self.mime = mime
+        self.queued_at = time.time() if queued_at is None else queued_at
+        self.content_id = content_id  # 'document:<id>' / 'photo:<id>', the same for every repost of a file
+
+    @classmethod
+    def from_message(cls, message, entity, chat_title, file_name, size=0):
+        media = message.document or message.photo
+        return cls(
+            entity.id, message.id, chat_title, file_name, size,
+            getattr(media, 'dc_id', None), int(message.date.timestamp()),
+            message.document.mime_type if message.document else None,
+            content_id=f"{'document' if message.document else 'photo'}:{media.id}" if media else None
+        )
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(*record)
+
+    def to_record(self):
+        return [getattr(self, slot) for slot in self.__slots__]
+
+    @property
+    def month(self):
+        """YYYY-MM folder of the message date (UTC)."""
+        return time.strftime('%Y-%m', time.gmtime(self.date))
+
+class Lane:
+    """Per-channel queues served round-robin so one large channel cannot starve the others."""
+
+    def __init__(self):
+        self.channels = {}  # channel_id -> heap of (key, task)
+        self.order = deque()  # channel ids with queued tasks, in round-robin order
+        self.depth = 0
+        self.waits = deque(maxlen=1000)  # recent queue wait times in seconds
+
+    def push(self, key, task):
+        if task.channel_id not in self.channels:
+            self.channels[task.channel_id] = []
+            self.order.append(task.channel_id)
+        heapq.heappush(self.channels[task.channel_id], (key, task))
+        self.depth += 1
+
+    def pop(self):
+        channel_id = self.order.popleft()
+        heap = self.channels[channel_id]
+        _, task = heapq.heappop(heap)
+        if heap:
+            self.order.append(channel_id)
+        else:
+            del self.channels[channel_id]
+        self.depth -= 1
+        self.waits.append(time.time() - task.queued_at)
+        return task
+
+class TaskStore:
+    """Durable SQLite journal of queued tasks with claim/ack; also holds tasks beyond the in-memory window.
+
+    A task stays in the journal from put() until it is acked, so work claimed by a worker or
+    waiting for upload when the process stopped is replayed on the next start.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            lane TEXT NOT NULL,
+            record TEXT NOT NULL,
+            claimed INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (channel_id, message_id)
+        )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_lane_channel ON tasks (lane, channel_id, id)')
+        self.conn.execute('DROP TABLE IF EXISTS spill')
+        self.conn.execute('UPDATE tasks SET claimed = 0')
+        self.loaded_upto = {}  # (lane, channel_id) -> highest row id read into memory
+        self.spilled = {lane: {} for lane in LANES}  # lane -> {channel_id: rows not yet read into memory}
+        self.counts = {lane: 0 for lane in LANES}  # rows per lane not yet read into memory
+        for lane, channel_id, count in self.conn.execute('SELECT lane, channel_id, COUNT(*) FROM tasks GROUP BY lane, channel_id'):
+            if lane in self.spilled:
+                self.spilled[lane][channel_id] = count
+                self.counts[lane] += count
+
+    def push(self, lane, task):
+        """Journal a task; returns its row id, or None if the message is already queued."""
+        cursor = self.conn.execute(
+            'INSERT OR IGNORE INTO tasks (channel_id, message_id, lane, record) VALUES (?, ?, ?, ?)',
+            (task.channel_id, task.message_id, lane, json.dumps(task.to_record(), ensure_ascii=False))
+        )
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def spill(self, lane, channel_id):
+        """Leave a journaled task on disk until its channel's earlier tasks have been read."""
+        self.spilled[lane][channel_id] = self.spilled[lane].get(channel_id, 0) + 1
+        self.counts[lane] += 1
+
+    def load(self, lane, channel_ids, limit):
+        """Read the next unloaded tasks of each given channel of a lane, about `limit` in total split evenly."""
+        share = max(1, -(-limit // len(channel_ids)))
+        tasks = []
+        for channel_id in channel_ids:
+            rows = self.conn.execute(
+                'SELECT id, record FROM tasks WHERE lane = ? AND channel_id = ? AND id > ? ORDER BY id LIMIT ?',
+                (lane, channel_id, self.loaded_upto.get((lane, channel_id), 0), share)
+            ).fetchall()
+            if not rows:
+                # The count drifted from the journal: nothing of this channel is left on disk
+                self.counts[lane] -= self.spilled[lane].pop(channel_id, 0)
+                continue
+            self.loaded_upto[(lane, channel_id)] = rows[-1][0]
+            self.counts[lane] -= len(rows)
+            left = self.spilled[lane][channel_id] - len(rows)
+            if left > 0:
+                self.spilled[lane][channel_id] = left
+            else:
+                # Its later tasks go straight to memory again
+                del self.spilled[lane][channel_id]
+            tasks += [DownloadTask.from_record(json.loads(record)) for _, record in rows]
+        return tasks
+
+    def claim(self, task):
+        self.conn.execute('UPDATE tasks SET claimed = 1 WHERE channel_id = ? AND message_id = ?', (task.channel_id, task.message_id))
+
+    def ack(self, channel_id, message_id):
+        self.conn.execute('DELETE FROM tasks WHERE channel_id = ? AND message_id = ?', (channel_id, message_id))
+
+    def contains(self, channel_id, message_id):
+        return self.conn.execute(
+            'SELECT 1 FROM tasks WHERE channel_id = ? AND message_id = ?', (channel_id, message_id)
+        ).fetchone() is not None
+
+    def journal_stats(self):
+        total, claimed = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(claimed), 0) FROM tasks').fetchone()
+        return {'tasks': total, 'claimed': claimed}
+
+class DownloadScheduler:
+    """Durable download queue of DownloadTasks with priority lanes and per-channel fairness.
+
+    Every task is journaled in a TaskStore; at most QUEUE_MEMORY_ITEMS of them are held in memory.
+    """
+
+    def __init__(self, db_path=None):
+        self.lanes = {lane: Lane() for lane in LANES}
+        self.store = TaskStore(db_path or os.path.join(config.PROGRESS_DIR, 'queue.db'))
+        self._seq = 0
+        self._not_empty = asyncio.Event()
+        self._unfinished = 0
+
+    def _key(self, size):
+        # With SMALL_FILE_FIRST_KB set, small media in a channel go ahead of larger files, smallest first
+        self._seq += 1
+        if size and size <= config.SMALL_FILE_FIRST_KB * 1024:
+            return (0, size, self._seq)
+        return (1, 0, self._seq)
+
+    def _in_memory(self):
+        return sum(lane.depth for lane in self.lanes.values())
+
+    async def put(self, task, lane='backfill'):
+        """Queue a DownloadTask on a lane; returns False if the message is already queued."""
+        row_id = self.store.push(lane, task)
+        if row_id is None:
+            return False
+        # Once a channel has tasks on disk, its later tasks queue behind them to keep their order
+        if self.store.spilled[lane].get(task.channel_id) or self._in_memory() >= config.QUEUE_MEMORY_ITEMS:
+            self.store.spill(lane, task.channel_id)
+        else:
+            self.store.loaded_upto[(lane, task.channel_id)] = row_id
+            self.lanes[lane].push(self._key(task.size), task)
+        self._unfinished += 1
+        self._not_empty.set()
+        return True
+
+    def _refill(self, lane):
+        spilled = self.store.spilled[lane]
+        if not spilled:
+            return
+        queued = self.lanes[lane]
+        room = config.QUEUE_MEMORY_ITEMS - self._in_memory()
+        # Channels whose tasks are all on disk take the first free slots, so they join the round-robin
+        absent = [channel_id for channel_id in spilled if channel_id not in queued.channels]
+        # An empty higher-priority lane is refilled even while the window is full of lower-priority work
+        if room >= config.QUEUE_MEMORY_ITEMS // 2 or not queued.depth or (room > 0 and absent):
+            channel_ids = [channel_id for channel_id in queued.order if channel_id in spilled] + absent
+            for task in self.store.load(lane, channel_ids, max(room, LOAD_BATCH)):
+                queued.push(self._key(task.size), task)
+
+    async def get(self):
+        while True:
+            while self.empty():
+                self._not_empty.clear()
+                await self._not_empty.wait()
+            for lane in LANES:
+                self._refill(lane)
+                if self.lanes[lane].depth:
+                    task = self.lanes[lane].pop()
+                    self.store.claim(task)
+                    return task
+            # Nothing came back from disk: the refill corrected drifted counts, so wait again
+
+    def task_done(self):
+        self._unfinished -= 1
+
+    def ack(self, channel_id, message_id):
+        """Drop a finished task from the journal (completed, failed for good, or handed to retries)."""
+        self.store.ack(channel_id, message_id)
+
+    def contains(self, channel_id, message_id):
+        return self.store.contains(channel_id, message_id)
+
+    def upcoming(self, channel_id, limit):
+        """Message ids of the next in-memory tasks of a channel, across lanes."""
+        ids = []
+        for lane in self.lanes.values():
+            ids += [task.message_id for _, task in heapq.nsmallest(limit, lane.channels.get(channel_id, ()))]
+        return ids[:limit]
+
+    def qsize(self):
+        return self._in_memory() + sum(self.store.counts.values())
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def lane_stats(self):
+        """Depth, on-disk count, channel count and wait-time percentiles (seconds) per lane."""
+        stats = {}
+        for name, lane in self.lanes.items():
+            waits = sorted(lane.waits)
+            pct = lambda p: waits[min(len(waits) - 1, int(p * len(waits)))] if waits else 0
+            stats[name] = {
+                'depth': lane.depth + self.store.counts[name], 'on_disk': self.store.counts[name],
+                'channels': len(lane.channels), 'p50': pct(0.5), 'p95': pct(0.95), 'p99': pct(0.99)
+            }
+        return stats
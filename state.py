@@ -1,5 +1,6 @@
 import asyncio
 import time
+from collections import deque
 import config
 
 # Telegram clients
@@ -9,7 +10,22 @@ bot = None
 # Queue for downloads
 queue = None
 
+# Upload stage: finished downloads waiting for rclone
+upload_queue = None
+upload_backlog_bytes = 0
+active_uploads = 0
+upload_history = deque(maxlen=100)
+
+# Download concurrency limiter and the signals that tune it
+download_limiter = None
+downloaded_bytes = 0  # bytes received by all downloads since startup
+flood_waits = 0  # FloodWaits on file part requests; history and entity ones do not slow downloads
+download_timeouts = 0
+download_stalls = 0  # downloads cancelled by the stall watchdog
+
 # Health monitoring state
+started_at = time.time()
+first_download_at = None  # when the first download after startup began
 last_download_activity = time.time()
 active_downloads = {}
 last_progress_report = time.time()
@@ -27,8 +43,10 @@ channel_scan_state = {}  # channel_id -> state
 download_all_chat = config.DOWNLOAD_ALL_ENV_SET
 all_chat_listener_registered = False
 
-# Caches
-group_caption_cache = {}  # grouped_id -> caption
+# Recent per-file download throughput samples
+transfer_history = deque(maxlen=100)
+resumed_bytes = 0  # bytes reused from .part files instead of being downloaded again
+streamed_bytes = 0  # bytes piped straight to the remote without touching local disk
 
 async def update_download_activity():
     """Update last download activity timestamp"""
@@ -36,6 +54,22 @@ async def update_download_activity():
     last_download_activity = time.time()
 
 def update_active_download(key, downloaded):
-    """Update downloaded bytes for an active task."""
+    """Update downloaded bytes for an active task, with its last-progress time and rolling rate."""
+    global downloaded_bytes
     if key in active_downloads:
-        active_downloads[key]['downloaded'] = downloaded
+        info = active_downloads[key]
+        now = time.time()
+        samples = info['samples']
+        if not samples:
+            samples.append((info['start_time'], info['downloaded']))
+        if downloaded > info['downloaded']:
+            downloaded_bytes += downloaded - info['downloaded']
+            info['last_progress'] = now
+        info['downloaded'] = downloaded
+        # At most one sample per second, covering the last STALL_RATE_WINDOW seconds
+        if now - samples[-1][0] >= 1:
+            samples.append((now, downloaded))
+            while len(samples) > 2 and now - samples[1][0] >= config.STALL_RATE_WINDOW:
+                samples.popleft()
+        first_time, first_bytes = samples[0]
+        info['rate'] = (downloaded - first_bytes) / (now - first_time) if now > first_time else 0
@@ -1,20 +1,39 @@
 import os
 import re
-import json
+import time
 import logging
-from datetime import datetime
 import config
+import progress_store
+import utils
 
 logger = logging.getLogger('tg_downloader')
 
 whitelist = []
 whitelist_file_mtime = None
+_whitelist_ids = set()  # bare chat ids of `whitelist`, rebuilt by refresh_whitelist()
+_backend = None
+_indexes = {}  # channel_id -> CompletionIndex
+_channel_stats = {}  # channel_id -> counters, kept in step with the backend
+_totals = {'completed': 0, 'failed': 0, 'pending': 0, 'bytes': 0}
+_started = {}  # (channel_id, message_id) -> retry count of recently queued files, answered without a backend read
+# Upper bound on remembered starts; older ones fall back to a backend read
+STARTED_CACHE_MAX_ITEMS = 10000
+
+# In-memory counter name -> persisted channel field
+COUNTER_FIELDS = {
+    'completed': 'completed_count',
+    'failed': 'failed_count',
+    'pending': 'pending_count',
+    'bytes': 'completed_bytes'
+}
+_backend_started = time.time()
 
 def init_progress_dir():
     """Initialize progress directory for tracking download progress"""
     if not os.path.exists(config.PROGRESS_DIR):
         os.makedirs(config.PROGRESS_DIR)
         logger.info(f'Progress directory created: {config.PROGRESS_DIR}')
+    get_backend()
 
 def load_whitelist_from_file():
     """Load whitelist IDs from file."""
@@ -47,6 +66,16 @@ def load_whitelist_from_file():
             whitelist_file_mtime = None
     except Exception as e:
         logger.warning(f'Failed to load whitelist file: {e}')
+    refresh_whitelist()
+
+def refresh_whitelist():
+    """Rebuild the normalized whitelist lookup after `whitelist` changes."""
+    global _whitelist_ids
+    _whitelist_ids = {utils.bare_chat_id(i) for i in whitelist}
+
+def is_whitelisted(chat_id):
+    """Whether a chat id in any form (bare, negative or -100 prefixed) is on the whitelist."""
+    return utils.bare_chat_id(chat_id) in _whitelist_ids
 
 def save_whitelist_to_file(ids):
     """Persist IDs to whitelist file."""
@@ -89,153 +118,321 @@ def save_whitelist_to_file(ids):
     except Exception as e:
         logger.warning(f'Failed to save whitelist file: {e}')
 
+def get_backend():
+    """Return the progress backend, creating it on first use."""
+    global _backend, _backend_started
+    if _backend is None:
+        if not os.path.exists(config.PROGRESS_DIR):
+            os.makedirs(config.PROGRESS_DIR)
+        _backend = progress_store.create_backend(
+            config.PROGRESS_BACKEND, config.PROGRESS_DIR, config.PROGRESS_DB_FILE,
+            config.PROGRESS_COMMIT_BATCH, config.PROGRESS_FLUSH_INTERVAL
+        )
+        _backend_started = time.time()
+        logger.info(f'Progress backend: {_backend.name}')
+        _load_stats()
+    return _backend
+
+def get_progress_metrics():
+    """Logical progress writes vs physical flushes since startup."""
+    elapsed = max(time.time() - _backend_started, 1e-6)
+    backend = get_backend()
+    return {
+        'backend': backend.name,
+        'writes': backend.write_count,
+        'flushes': backend.flush_count,
+        'flushes_per_sec': backend.flush_count / elapsed
+    }
+
+def flush_progress():
+    """Persist any buffered progress writes."""
+    if _backend is not None:
+        _backend.flush()
+
+def close_progress():
+    """Flush and close the progress backend."""
+    global _backend
+    if _backend is not None:
+        _backend.close()
+        _backend = None
+        _indexes.clear()
+        _channel_stats.clear()
+
 def get_progress_file(channel_id):
-    """Get progress file path for a channel."""
+    """Get progress file path for a channel (JSON backend)."""
     return os.path.join(config.PROGRESS_DIR, f'channel_{channel_id}.json')
 
-def load_channel_progress(channel_id):
-    """Load progress for a specific channel."""
-    progress_file = get_progress_file(channel_id)
-    if os.path.exists(progress_file):
+def list_channel_ids():
+    """List IDs of all channels with progress records."""
+    return get_backend().channel_ids()
+
+def _load_channel_stats(channel_id):
+    """(Re)load one channel's persisted counters into memory."""
+    summary = _backend.get_channel(channel_id)
+    old = _channel_stats.get(channel_id)
+    if old:
+        for key in COUNTER_FIELDS:
+            _totals[key] -= old[key]
+    counters = {key: summary[field] for key, field in COUNTER_FIELDS.items()}
+    counters['channel_id'] = channel_id
+    counters['channel_name'] = summary['channel_name']
+    _channel_stats[channel_id] = counters
+    for key in COUNTER_FIELDS:
+        _totals[key] += counters[key]
+    return counters
+
+def _load_stats():
+    """Load all channel counters once when the backend is opened."""
+    _channel_stats.clear()
+    for key in _totals:
+        _totals[key] = 0
+    for ch_id in _backend.channel_ids():
         try:
-            with open(progress_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            _load_channel_stats(ch_id)
         except Exception as e:
-            logger.error(f'Error loading progress file: {e}')
-    
-    return {
-        'channel_id': channel_id,
-        'channel_name': '',
-        'last_message_id': 0,
-        'downloading': {},
-        'completed_count': 0,
-        'failed_count': 0,
-        'failed_ids': []
-    }
+            logger.error(f'Error reading stats for channel {ch_id}: {e}')
+
+def _count(channel_id, **deltas):
+    """Apply counter deltas in memory; returns the channel fields to persist."""
+    counters = _channel_stats.get(channel_id) or _load_channel_stats(channel_id)
+    fields = {}
+    for key, delta in deltas.items():
+        counters[key] += delta
+        _totals[key] += delta
+        fields[COUNTER_FIELDS[key]] = counters[key]
+    return fields
+
+def _get_index(channel_id):
+    """Return the cached completion index for a channel."""
+    index = _indexes.get(channel_id)
+    if index is None:
+        backend = get_backend()
+        summary = backend.get_channel(channel_id)
+        failed = [mid for mid, _ in backend.list_messages(channel_id, 'failed')]
+        index = progress_store.CompletionIndex(
+            summary['watermark'], summary['completed_ranges'], failed, config.COMPLETION_MAX_RANGES,
+            summary['scanned_id'], progress_store.SpilledRanges(backend, channel_id)
+        )
+        _indexes[channel_id] = index
+    return index
+
+def _store_index(backend, channel_id, index, **fields):
+    """Advance the watermark past finished ranges and persist the index."""
+    index.advance(backend.min_pending(channel_id))
+    backend.update_channel(
+        channel_id, watermark=index.watermark, scanned_id=index.scanned, completed_ranges=index.to_ranges(),
+        last_message_id=index.highest(), **fields
+    )
+
+def record_scanned(channel_id, from_id, up_to):
+    """Note that a scan starting after `from_id` has recorded every message up to `up_to`.
+
+    Only a scan continuing the already scanned prefix extends it; the watermark never passes it.
+    """
+    backend = get_backend()
+    with backend.session(channel_id):
+        index = _get_index(channel_id)
+        if from_id > index.scanned or up_to <= index.scanned:
+            return
+        index.scanned = up_to
+        _store_index(backend, channel_id, index)
+
+def get_channel_summary(channel_id):
+    """Channel name, watermark and counters without listing message records."""
+    return get_backend().get_channel(int(channel_id))
+
+def load_channel_progress(channel_id):
+    """Load progress for a specific channel."""
+    channel_id = int(channel_id)
+    backend = get_backend()
+    with backend.session(channel_id):
+        progress = backend.get_channel(channel_id)
+        progress['downloading'] = {str(mid): retry for mid, retry in backend.list_messages(channel_id, 'downloading')}
+        progress['failed_ids'] = [mid for mid, _ in backend.list_messages(channel_id, 'failed')]
+    return progress
 
 def save_channel_progress(channel_id, progress):
     """Save progress for a specific channel."""
-    progress_file = get_progress_file(channel_id)
-    progress['last_update'] = datetime.now().isoformat()
-    try:
-        with open(progress_file, 'w', encoding='utf-8') as f:
-            json.dump(progress, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        logger.error(f'Error saving progress file: {e}')
+    channel_id = int(channel_id)
+    backend = get_backend()
+    with backend.session(channel_id):
+        summary = progress_store.new_channel_summary(channel_id)
+        backend.update_channel(channel_id, **{k: progress.get(k, v) for k, v in summary.items() if k != 'channel_id'})
+        backend.clear_messages(channel_id)
+        for mid, val in progress.get('downloading', {}).items():
+            backend.set_message(channel_id, int(mid), 'downloading', progress_store._retry_from_value(val))
+        for mid in progress.get('failed_ids', []):
+            if str(mid) not in progress.get('downloading', {}):
+                backend.set_message(channel_id, int(mid), 'failed')
+        backend.update_channel(
+            channel_id,
+            pending_count=backend.count_messages(channel_id, 'downloading'),
+            failed_count=backend.count_messages(channel_id, 'failed')
+        )
+        _load_channel_stats(channel_id)
+    _indexes.pop(channel_id, None)
+    for key in [key for key in _started if key[0] == channel_id]:
+        del _started[key]
 
 def record_file_start(channel_id, channel_name, message_id):
     """Record the start of a file download with minimal info (ID only)."""
-    progress = load_channel_progress(channel_id)
-    progress['channel_name'] = channel_name
-    
-    # Handle legacy dict or new int
-    current_val = progress['downloading'].get(str(message_id))
-    retry_count = 0
-    if isinstance(current_val, dict):
-        retry_count = current_val.get('retry_count', 0)
-    elif isinstance(current_val, int):
-        retry_count = current_val
-        
-    progress['downloading'][str(message_id)] = retry_count
-    save_channel_progress(channel_id, progress)
-
-def record_file_complete(channel_id, message_id, status='completed', error_message=None):
-    """Record file download completion or failure."""
-    progress = load_channel_progress(channel_id)
-    msg_id_str = str(message_id)
-    
-    if status == 'completed':
-        if msg_id_str in progress['downloading']:
-            del progress['downloading'][msg_id_str]
-            progress['completed_count'] += 1
-            # Remove from failed_ids if present (e.g. successful retry)
-            if message_id in progress.get('failed_ids', []):
-                progress['failed_ids'].remove(message_id)
-        progress['last_message_id'] = max(progress['last_message_id'], message_id)
-        save_channel_progress(channel_id, progress)
-    else:
-        if msg_id_str in progress['downloading']:
-            # Handle legacy dict or new int
-            current_val = progress['downloading'][msg_id_str]
-            retry_count = 0
-            if isinstance(current_val, dict):
-                retry_count = current_val.get('retry_count', 0)
-            elif isinstance(current_val, int):
-                retry_count = current_val
-            
-            retry_count += 1
-            progress['downloading'][msg_id_str] = retry_count
-            
-            if retry_count >= config.MAX_RETRIES:
-                del progress['downloading'][msg_id_str]
-                progress['failed_count'] += 1
-                if 'failed_ids' not in progress:
-                    progress['failed_ids'] = []
-                if message_id not in progress['failed_ids']:
-                    progress['failed_ids'].append(message_id)
-        progress['last_message_id'] = max(progress['last_message_id'], message_id)
-        save_channel_progress(channel_id, progress)
+    backend = get_backend()
+    with backend.session(channel_id):
+        entry = backend.get_message(channel_id, message_id)
+        fields = {}
+        counters = _channel_stats.get(channel_id) or _load_channel_stats(channel_id)
+        if counters['channel_name'] != channel_name:
+            counters['channel_name'] = fields['channel_name'] = channel_name
+        if entry is None:
+            fields.update(_count(channel_id, pending=1))
+        elif entry[0] == 'failed':
+            fields.update(_count(channel_id, pending=1, failed=-1))
+        if fields:
+            backend.update_channel(channel_id, **fields)
+        retry_count = entry[1] if entry and entry[0] == 'downloading' else 0
+        backend.set_message(channel_id, message_id, 'downloading', retry_count)
+        _get_index(channel_id).failed.discard(message_id)
+    _started.pop((channel_id, message_id), None)
+
+def record_files_started(channel_id, channel_name, message_ids):
+    """Record the start of many downloads of one channel with a single status read."""
+    backend = get_backend()
+    with backend.session(channel_id):
+        entries = backend.get_messages(channel_id, message_ids)
+        index = _get_index(channel_id)
+        fields = {}
+        counters = _channel_stats.get(channel_id) or _load_channel_stats(channel_id)
+        if counters['channel_name'] != channel_name:
+            counters['channel_name'] = fields['channel_name'] = channel_name
+        new = sum(1 for mid in message_ids if mid not in entries)
+        failed = sum(1 for entry in entries.values() if entry[0] == 'failed')
+        if new or failed:
+            fields.update(_count(channel_id, pending=new + failed, failed=-failed))
+        if fields:
+            backend.update_channel(channel_id, **fields)
+        for message_id in message_ids:
+            entry = entries.get(message_id)
+            retry_count = entry[1] if entry and entry[0] == 'downloading' else 0
+            backend.set_message(channel_id, message_id, 'downloading', retry_count)
+            index.failed.discard(message_id)
+            if len(_started) >= STARTED_CACHE_MAX_ITEMS:
+                del _started[next(iter(_started))]
+            _started[(channel_id, message_id)] = retry_count
+
+def record_file_complete(channel_id, message_id, status='completed', error_message=None, file_size=0, final=False):
+    """Record file download completion or failure; a `final` failure uses up the file's remaining retries."""
+    _started.pop((channel_id, message_id), None)
+    backend = get_backend()
+    with backend.session(channel_id):
+        index = _get_index(channel_id)
+        entry = backend.get_message(channel_id, message_id)
+        downloading = entry is not None and entry[0] == 'downloading'
+
+        if status == 'completed':
+            fields = {}
+            if entry:
+                previous = 'pending' if downloading else 'failed'
+                fields = _count(channel_id, completed=1, bytes=file_size or 0, **{previous: -1})
+                # Also clears a failure record (e.g. successful retry)
+                backend.delete_message(channel_id, message_id)
+            index.failed.discard(message_id)
+            index.add(message_id)
+            _store_index(backend, channel_id, index, **fields)
+        elif downloading:
+            retry_count = entry[1] + 1
+            if final or retry_count >= config.MAX_RETRIES:
+                backend.set_message(channel_id, message_id, 'failed', max(retry_count, config.MAX_RETRIES))
+                index.failed.add(message_id)
+                index.add(message_id)
+                _store_index(backend, channel_id, index, **_count(channel_id, pending=-1, failed=1))
+            else:
+                backend.set_message(channel_id, message_id, 'downloading', retry_count)
+
+def get_resume_offset(channel_id, message_id):
+    """Checkpointed byte offset of a partially downloaded file (0 if none)."""
+    return get_backend().get_offset(channel_id, message_id)
+
+def record_download_offset(channel_id, message_id, offset):
+    """Checkpoint the verified byte offset of an in-progress download."""
+    backend = get_backend()
+    with backend.session(channel_id):
+        backend.set_offset(channel_id, message_id, offset)
 
 def get_file_status(channel_id, message_id):
-    """Check if a file has been completed or is downloading."""
-    progress = load_channel_progress(channel_id)
-    msg_id_str = str(message_id)
-    if msg_id_str in progress['downloading']:
-        val = progress['downloading'][msg_id_str]
-        retry = val if isinstance(val, int) else val.get('retry_count', 0)
-        return ('downloading', '', retry)
-    if message_id <= progress['last_message_id']:
+    """Check if a file has been completed, failed or is downloading."""
+    index = _get_index(channel_id)
+    if message_id in index.failed:
+        return ('failed', '', config.MAX_RETRIES)
+    # A start recorded by record_files_started still stands until the file is finished
+    retry_count = _started.pop((channel_id, message_id), None)
+    if retry_count is not None:
+        return ('downloading', '', retry_count)
+    entry = get_backend().get_message(channel_id, message_id)
+    if entry and entry[0] == 'downloading':
+        return ('downloading', '', entry[1])
+    if message_id in index:
         return ('completed', '', 0)
     return None
 
+def get_file_statuses(channel_id, message_ids):
+    """get_file_status for many messages of one channel with a single backend read; {message_id: status}."""
+    index = _get_index(channel_id)
+    entries = get_backend().get_messages(channel_id, [mid for mid in message_ids if mid not in index.failed])
+    statuses = {}
+    for message_id in message_ids:
+        entry = entries.get(message_id)
+        if message_id in index.failed:
+            statuses[message_id] = ('failed', '', config.MAX_RETRIES)
+        elif entry and entry[0] == 'downloading':
+            statuses[message_id] = ('downloading', '', entry[1])
+        elif message_id in index:
+            statuses[message_id] = ('completed', '', 0)
+        else:
+            statuses[message_id] = None
+    return statuses
+
 def get_pending_files(channel_id=None):
     """Get all pending files for retry."""
+    backend = get_backend()
     pending = []
-    if not os.path.exists(config.PROGRESS_DIR):
-        return pending
-    
-    for filename in os.listdir(config.PROGRESS_DIR):
-        if not filename.startswith('channel_') or not filename.endswith('.json'):
+    for ch_id in backend.channel_ids():
+        if channel_id and ch_id != channel_id:
             continue
-        filepath = os.path.join(config.PROGRESS_DIR, filename)
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                progress = json.load(f)
-                if channel_id and progress['channel_id'] != channel_id:
-                    continue
-                for msg_id, val in progress['downloading'].items():
-                    retry = val if isinstance(val, int) else val.get('retry_count', 0)
-                    fname = None if isinstance(val, int) else val.get('file_name')
-                    if retry < config.MAX_RETRIES:
-                        pending.append((progress['channel_id'], int(msg_id), fname, retry))
-        except Exception as e:
-            logger.error(f'Error reading {filename}: {e}')
-    
+        for msg_id, retry in backend.list_messages(ch_id, 'downloading'):
+            if retry < config.MAX_RETRIES:
+                pending.append((ch_id, msg_id, None, retry))
     return sorted(pending, key=lambda x: (x[0], x[1]))
 
 def get_download_stats():
-    """Get download statistics."""
-    total_completed = 0
-    total_failed = 0
-    total_downloading = 0
-    
-    if not os.path.exists(config.PROGRESS_DIR):
-        return {'total': 0, 'completed': 0, 'failed': 0, 'pending': 0}
-    
-    for filename in os.listdir(config.PROGRESS_DIR):
-        if filename.startswith('channel_') and filename.endswith('.json'):
-            filepath = os.path.join(config.PROGRESS_DIR, filename)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    progress = json.load(f)
-                    total_completed += progress.get('completed_count', 0)
-                    total_failed += progress.get('failed_count', 0)
-                    # Sync failed_count with failed_ids length if available
-                    if 'failed_ids' in progress:
-                        total_failed = total_failed - progress.get('failed_count', 0) + len(progress['failed_ids'])
-                    total_downloading += len(progress.get('downloading', {}))
-            except Exception as e:
-                logger.error(f'Error reading stats from {filename}: {e}')
-    
-    total = total_completed + total_failed + total_downloading
-    return {'total': total, 'completed': total_completed, 'failed': total_failed, 'pending': total_downloading}
+    """Get download statistics from the in-memory counters."""
+    get_backend()
+    total = _totals['completed'] + _totals['failed'] + _totals['pending']
+    return {
+        'total': total, 'completed': _totals['completed'], 'failed': _totals['failed'],
+        'pending': _totals['pending'], 'bytes': _totals['bytes']
+    }
+
+def get_channel_stats():
+    """Per-channel counters (channel_id, channel_name, completed, failed, pending, bytes)."""
+    get_backend()
+    return [dict(c) for c in _channel_stats.values()]
+
+def reconcile_download_stats():
+    """Repair counters by recounting pending/failed records of every channel."""
+    backend = get_backend()
+    fixed = 0
+    for ch_id in backend.channel_ids():
+        try:
+            with backend.session(ch_id):
+                summary = backend.get_channel(ch_id)
+                pending = backend.count_messages(ch_id, 'downloading')
+                failed = backend.count_messages(ch_id, 'failed')
+                if summary['pending_count'] != pending or summary['failed_count'] != failed:
+                    backend.update_channel(ch_id, pending_count=pending, failed_count=failed)
+                    fixed += 1
+        except Exception as e:
+            logger.error(f'Error reconciling stats for channel {ch_id}: {e}')
+    _load_stats()
+    if fixed:
+        logger.warning(f'Reconciled download counters for {fixed} channels')
+    return get_download_stats()
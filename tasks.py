@@ -5,8 +5,10 @@ import json
 import logging
 import config
 import state
+import concurrency
 import storage
-import downloader
+import scanner
+import utils
 
 logger = logging.getLogger('tg_downloader')
 
@@ -21,10 +23,8 @@ async def watch_whitelist_file(poll_interval=5):
                     logger.info(f'Whitelist reloaded: {storage.whitelist}')
                     if not config.DOWNLOAD_ALL_ENV_SET and storage.whitelist:
                         if state.client and not state.all_chat_listener_registered:
-                            from client import all_chat_download  # Local import to avoid circular dependency
-                            from telethon import events
-                            state.client.add_event_handler(all_chat_download, events.NewMessage())
-                            state.all_chat_listener_registered = True
+                            from client import register_live_listener  # Local import to avoid circular dependency
+                            register_live_listener()
                             state.download_all_chat = True
                             logger.info('Auto-download listener registered by watcher')
                     if not config.DOWNLOAD_ALL_ENV_SET and not storage.whitelist:
@@ -44,16 +44,14 @@ async def periodic_rescan_task():
     while True:
         try:
             await asyncio.sleep(30)
-            if not os.path.exists(config.PROGRESS_DIR): continue
             
-            for filename in os.listdir(config.PROGRESS_DIR):
-                if not filename.startswith('channel_') or not filename.endswith('.json'): continue
-                
+            for ch_id in storage.list_channel_ids():
                 try:
-                    progress = storage.load_channel_progress(filename[8:-5])
-                    ch_id = progress['channel_id']
+                    progress = storage.get_channel_summary(ch_id)
                     ch_name = progress.get('channel_name', f'Channel {ch_id}')
                     last_message_id = progress.get('last_message_id', 0)
+                    # Continue from the scanned prefix: live posts above it must not make the rescan skip the gap
+                    scanned_id = progress.get('scanned_id', 0)
                     
                     if ch_id not in state.channel_scan_state:
                         state.channel_scan_state[ch_id] = {
@@ -69,18 +67,38 @@ async def periodic_rescan_task():
                         entity = await state.client.get_entity(ch_id)
                         logger.info(f'[RESCAN] Triggered for {ch_name}')
                         
-                        queued, last_id, scanned = await downloader.process_channel_messages(
-                            entity, ch_name, offset_id=last_message_id, limit=config.SCAN_BATCH_SIZE
+                        queued, last_id, scanned = await scanner.scan_range(
+                            entity, ch_name, offset_id=scanned_id, limit=config.SCAN_BATCH_SIZE,
+                            on_progress=lambda up_to: storage.record_scanned(ch_id, scanned_id, up_to)
                         )
                         
                         state_info['last_scanned_id'] = last_id
                         state_info['last_download_count'] = progress.get('completed_count', 0)
                         state_info['last_scan_time'] = time.time()
                 except Exception as e:
-                    logger.warning(f'Error rescaning {filename}: {e}')
+                    logger.warning(f'Error rescaning channel {ch_id}: {e}')
         except Exception as e:
             logger.error(f'Periodic rescan error: {e}')
 
+async def progress_flush_task():
+    """Periodically persist buffered progress writes."""
+    while True:
+        await asyncio.sleep(config.PROGRESS_FLUSH_INTERVAL)
+        try:
+            storage.flush_progress()
+        except Exception as e:
+            logger.error(f'Progress flush error: {e}')
+
+async def concurrency_controller_task():
+    """Periodically retune the number of active download workers."""
+    controller = concurrency.AimdController(state.download_limiter)
+    while True:
+        await asyncio.sleep(config.CONCURRENCY_ADJUST_INTERVAL)
+        try:
+            controller.step()
+        except Exception as e:
+            logger.error(f'Concurrency controller error: {e}')
+
 async def health_check_task():
     """Monitor download health."""
     while True:
@@ -91,8 +109,9 @@ async def health_check_task():
             
             # Stuck downloads check
             for key, info in list(state.active_downloads.items()):
-                if current_time - info['start_time'] > config.DOWNLOAD_TIMEOUT:
-                    logger.warning(f"Stuck download detected: {info['file_name']}")
+                idle = current_time - info['last_progress']
+                if idle > (config.STALL_TIMEOUT or config.DOWNLOAD_TIMEOUT):
+                    logger.warning(f"Stuck download detected: {info['file_name']} (no data for {int(idle)}s)")
             
             if state.active_downloads:
                 logger.info(f'Health: {len(state.active_downloads)} active, idle {int(idle_time)}s')
@@ -118,7 +137,7 @@ async def send_progress_report(force=False):
         total = stats['total']
         
         # Determine current activity
-        is_active = not state.queue.empty() or len(state.active_downloads) > 0
+        is_active = not state.queue.empty() or len(state.active_downloads) > 0 or state.upload_backlog_bytes > 0
         
         # Track batch start time
         if is_active and not state.was_active_last_check:
@@ -165,19 +184,19 @@ async def send_progress_report(force=False):
             state.was_active_last_check = is_active
             return
             
-        all_progress = []
-        if os.path.exists(config.PROGRESS_DIR):
-            for filename in os.listdir(config.PROGRESS_DIR):
-                if filename.startswith('channel_') and filename.endswith('.json'):
-                    all_progress.append(storage.load_channel_progress(filename[8:-5]))
+        all_progress = storage.get_channel_stats()
         
         # Build report
         status_icon = "⏳" if is_active else "✅"
         percent_str = f" ({current_percent}%)" if current_percent >= 0 else ""
         report = f'{status_icon} Progress Report{percent_str}\n'
-        report += f'Overall: {stats["completed"]} completed, {stats["failed"]} failed, {total} total\n'
-        report += f'Queue: {state.queue.qsize()} pending\n'
+        report += f'Overall: {stats["completed"]} completed, {stats["failed"]} failed, {total} total ({utils.bytes_to_string(stats["bytes"])})\n'
+        report += f'Queue: {state.queue.qsize()} pending'
+        live = state.queue.lane_stats()['live']['depth']
+        report += f' ({live} live)\n' if live else '\n'
         report += f'Active: {len(state.active_downloads)} downloads\n'
+        if config.UPLOAD_FILE_SET:
+            report += f'Uploads: {state.upload_queue.qsize()} queued, {state.active_uploads} active\n'
         
         # Show details of active downloads if any
         if state.active_downloads:
@@ -187,13 +206,13 @@ async def send_progress_report(force=False):
                 size = info['file_size']
                 dl = info.get('downloaded', 0)
                 p = int(dl/size*100) if size > 0 else 0
-                report += f"  • {fname[:30]}... {p}%\n"
+                report += f"  • {fname[:30]}... {p}% ({utils.bytes_to_string(info.get('rate', 0))}/s)\n"
         
         if all_progress and not is_active:
             batch_duration = int(now - state.batch_start_time) if state.batch_start_time > 0 else 0
             report += f'\nBatch Summary (Time: {batch_duration}s):\n'
             for prog in sorted(all_progress, key=lambda x: x.get('channel_name', '')):
-                completed = prog.get('completed_count', 0)
+                completed = prog.get('completed', 0)
                 if completed > 0:
                     report += f"  • {prog.get('channel_name', 'ID_'+str(prog['channel_id']))[:20]}: {completed} done\n"
         
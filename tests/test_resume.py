@@ -0,0 +1,97 @@
+import os
+import asyncio
+import pytest
+import config
+import state
+import storage
+import transfer
+
+CHANNEL_ID = 1
+DATA = os.urandom(5 * 1024 * 1024 + 777)
+
+class FailingClient:
+    """Stand-in client serving DATA that drops the connection after `fail_after` bytes."""
+
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.served = 0
+
+    async def iter_download(self, media, offset=0, limit=None, request_size=transfer.REQUEST_SIZE, file_size=None):
+        pos, requests = offset, 0
+        while pos < len(DATA) and (limit is None or requests < limit):
+            if self.fail_after is not None and self.served >= self.fail_after:
+                raise ConnectionError('connection lost')
+            await asyncio.sleep(0)
+            chunk = DATA[pos:pos + request_size]
+            self.served += len(chunk)
+            yield chunk
+            pos += len(chunk)
+            requests += 1
+
+class FakeMessage:
+    document = object()
+    media = object()
+
+@pytest.fixture
+def progress(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'PROGRESS_DIR', str(tmp_path / 'progress'))
+    monkeypatch.setattr(config, 'PROGRESS_DB_FILE', str(tmp_path / 'progress' / 'progress.db'))
+    monkeypatch.setattr(config, 'DOWNLOAD_CHECKPOINT_MB', 1)
+    monkeypatch.setattr(config, 'PARALLEL_DOWNLOAD_THRESHOLD_MB', 0)
+    storage.init_progress_dir()
+    yield
+    storage.close_progress()
+
+@pytest.mark.parametrize('parts', [1, 4])
+def test_download_resumes_from_checkpoint_after_failure(progress, tmp_path, monkeypatch, parts):
+    monkeypatch.setattr(config, 'PARALLEL_DOWNLOAD_PARTS', parts)
+    message_id = parts
+    path = str(tmp_path / 'video.mp4')
+    storage.record_file_start(CHANNEL_ID, 'channel', message_id)
+    checkpoint = lambda offset: storage.record_download_offset(CHANNEL_ID, message_id, offset)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(transfer.download_message(FailingClient(3 * 1024 * 1024), FakeMessage(), path, len(DATA), checkpoint=checkpoint))
+    offset = storage.get_resume_offset(CHANNEL_ID, message_id)
+    assert offset > 0
+    assert os.path.exists(transfer.part_path_for(path))
+    assert not os.path.exists(path)
+
+    client = FailingClient()
+    asyncio.run(transfer.download_message(client, FakeMessage(), path, len(DATA), offset=offset, checkpoint=checkpoint))
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert not os.path.exists(transfer.part_path_for(path))
+    # Only the bytes past the checkpoint are fetched again
+    assert client.served == len(DATA) - offset
+    assert state.resumed_bytes >= offset
+
+def test_resume_offset_is_cleared_when_file_completes(progress):
+    storage.record_file_start(CHANNEL_ID, 'channel', 10)
+    storage.record_download_offset(CHANNEL_ID, 10, 2 * transfer.REQUEST_SIZE)
+    assert storage.get_resume_offset(CHANNEL_ID, 10) == 2 * transfer.REQUEST_SIZE
+    storage.record_file_complete(CHANNEL_ID, 10, 'completed', file_size=len(DATA))
+    assert storage.get_resume_offset(CHANNEL_ID, 10) == 0
+
+def test_truncated_file_at_final_path_is_downloaded_again(progress, tmp_path, monkeypatch):
+    import downloader
+    import messages
+    import scheduler
+    monkeypatch.setattr(config, 'SAVE_PATH', str(tmp_path / 'downloads'))
+    monkeypatch.setattr(config, 'UPLOAD_FILE_SET', False)
+    monkeypatch.setattr(config, 'CONTENT_DEDUP', 'off')
+    monkeypatch.setattr(state, 'client', FailingClient())
+
+    async def fetch(channel_id, message_id):
+        return FakeMessage()
+    monkeypatch.setattr(messages, 'fetch', fetch)
+    task = scheduler.DownloadTask(CHANNEL_ID, 20, 'channel', 'video.mp4', len(DATA))
+    storage.record_file_start(CHANNEL_ID, 'channel', 20)
+    # An interrupted download from before .part files: the final path holds a prefix of the file
+    directory = tmp_path / 'downloads' / f'channel({CHANNEL_ID})' / task.month
+    directory.mkdir(parents=True)
+    (directory / 'video.mp4').write_bytes(DATA[:1024 * 1024])
+
+    asyncio.run(downloader.process_task('test', task))
+    assert (directory / 'video.mp4').read_bytes() == DATA
+    assert storage.get_file_status(CHANNEL_ID, 20)[0] == 'completed'
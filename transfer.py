@@ -0,0 +1,339 @@
+import os
+import math
+import errno
+import time
+import asyncio
+import inspect
+import logging
+import config
+import state
+import uploader
+
+logger = logging.getLogger('tg_downloader')
+
+# Telegram serves file parts in requests of at most 512 KiB; offsets must stay aligned to it
+REQUEST_SIZE = 512 * 1024
+# Download buffers are a whole number of pages
+BUFFER_ALIGN = 4096
+
+async def _report(progress_callback, downloaded, total):
+    if progress_callback:
+        result = progress_callback(downloaded, total)
+        if inspect.isawaitable(result):
+            await result
+
+async def _gather_or_cancel(coros):
+    """Run coroutines concurrently; cancel the rest as soon as one fails."""
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+def split_ranges(file_size, parts, start=0):
+    """Split [start, file_size) into at most `parts` request-aligned (offset, length) ranges."""
+    chunks = max(1, math.ceil((file_size - start) / REQUEST_SIZE))
+    part_size = math.ceil(chunks / max(1, parts)) * REQUEST_SIZE
+    return [(offset, min(part_size, file_size - offset)) for offset in range(start, file_size, part_size)]
+
+def part_path_for(path):
+    """Temporary path a download is written to before the final rename."""
+    return f'{path}.part'
+
+def _fadvise(fd, advice, offset=0, length=0):
+    # Hints only: skipped where posix_fadvise is missing or unsupported
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+class _RangeWriter:
+    """Buffered writer for one contiguous range of a DownloadSink; also usable as a file object."""
+
+    def __init__(self, sink, start):
+        self.sink = sink
+        self.pos = start  # everything before this offset (from the range start) is written out
+        self.buffer = bytearray()
+        self.done = False
+        self.lock = asyncio.Lock()  # one buffer write in flight at a time, so `pos` stays in order
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.sink.buffer_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.sink.pwrite(self.buffer, self.pos)
+            self.pos += len(self.buffer)
+            self.buffer = bytearray()
+
+    async def flush_async(self):
+        async with self.lock:
+            if self.buffer:
+                chunk, self.buffer = self.buffer, bytearray()
+                await self.sink.pwrite_async(chunk, self.pos)
+                self.pos += len(chunk)
+
+    async def write_async(self, data):
+        """write() that hands full buffers to a thread so disk latency does not stall the event loop."""
+        self.buffer += data
+        if len(self.buffer) >= self.sink.buffer_size:
+            await self.flush_async()
+
+    def finish(self):
+        self.flush()
+        self.done = True
+
+    async def finish_async(self):
+        await self.flush_async()
+        self.done = True
+
+class DownloadSink:
+    """Download target preallocated to its full size and written through aligned per-range buffers.
+
+    Created with `await DownloadSink.open(...)`. Preallocation, writes and fsync run in threads,
+    since each can block for long on slow or network filesystems.
+    """
+
+    def __init__(self, path, size, offset=0):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | (0 if offset else os.O_TRUNC), 0o644)
+        self.size = size
+        # Whole pages per write keep writes aligned, since ranges start on REQUEST_SIZE boundaries
+        self.buffer_size = -(-config.DOWNLOAD_BUFFER_KB * 1024 // BUFFER_ALIGN) * BUFFER_ALIGN
+        self.writers = []
+        self._pending = set()  # calls running in threads; the file is not closed under them
+        self.preallocated = False
+
+    @classmethod
+    async def open(cls, path, size, offset=0):
+        sink = cls(path, size, offset)
+        try:
+            await sink._in_thread(sink._prepare)
+        except BaseException:
+            if sink._pending:
+                await asyncio.gather(*sink._pending, return_exceptions=True)
+            os.close(sink.fd)
+            raise
+        return sink
+
+    def _prepare(self):
+        if self.size:
+            self._preallocate(self.size)
+        _fadvise(self.fd, getattr(os, 'POSIX_FADV_SEQUENTIAL', 2))
+
+    def _preallocate(self, size):
+        if config.DOWNLOAD_PREALLOCATE and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+                self.preallocated = True
+                return
+            except OSError as e:
+                if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                    raise
+                # Filesystem without fallocate support: fall back to a sparse file
+        os.ftruncate(self.fd, max(size, os.fstat(self.fd).st_size))
+
+    def writer(self, start):
+        writer = _RangeWriter(self, start)
+        self.writers.append(writer)
+        return writer
+
+    def pwrite(self, data, pos):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, pos)
+            view, pos = view[written:], pos + written
+
+    async def _in_thread(self, func, *args):
+        future = asyncio.get_running_loop().run_in_executor(None, func, *args)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        # Shielded so a cancelled download still waits for the call in close()
+        await asyncio.shield(future)
+
+    async def pwrite_async(self, data, pos):
+        await self._in_thread(self.pwrite, data, pos)
+
+    def verified_offset(self):
+        """Offset below which every byte is written: the lowest position of an unfinished range."""
+        return min((w.pos for w in self.writers if not w.done), default=self.size)
+
+    async def sync(self):
+        """Write out every buffer and fsync; returns the offset below which every byte is now on disk."""
+        for writer in self.writers:
+            await writer.flush_async()
+        verified = self.verified_offset()
+        await self._in_thread(os.fsync, self.fd)
+        return verified
+
+    def _finish(self, length):
+        os.fsync(self.fd)
+        if length is not None and os.fstat(self.fd).st_size > length:
+            os.ftruncate(self.fd, length)
+        if not config.UPLOAD_FILE_SET:
+            # Kept files are not read again soon; let the page cache drop them
+            _fadvise(self.fd, getattr(os, 'POSIX_FADV_DONTNEED', 4))
+
+    async def close(self, length=None):
+        """Flush every buffer and close; `length` trims preallocated space beyond the real size."""
+        try:
+            if self._pending:
+                await asyncio.gather(*self._pending, return_exceptions=True)
+            for writer in self.writers:
+                writer.flush()
+            await self._in_thread(self._finish, length)
+        finally:
+            os.close(self.fd)
+
+async def download_ranges(client, message, path, file_size, parts, offset=0, progress_callback=None, checkpoint=None, allocated=None):
+    """Download a document as concurrent byte ranges written at their offsets into a preallocated file.
+
+    Bytes below `offset` are kept from an earlier attempt. `checkpoint(verified)` is called
+    every DOWNLOAD_CHECKPOINT_MB with the offset below which every byte is on disk, and
+    `allocated()` once the file's full size is reserved on disk.
+    """
+    offset -= offset % REQUEST_SIZE
+    if offset >= file_size or not os.path.exists(path) or os.path.getsize(path) < offset:
+        offset = 0
+    ranges = split_ranges(file_size, parts, offset)
+    downloaded = offset
+    checkpoint_step = config.DOWNLOAD_CHECKPOINT_MB * 1024 * 1024
+    last_checkpoint = offset
+
+    sink = await DownloadSink.open(path, file_size, offset)
+    if sink.preallocated and allocated:
+        allocated()
+    writers = {start: sink.writer(start) for start, _ in ranges}
+
+    async def fetch(start, length):
+        nonlocal downloaded, last_checkpoint
+        writer, pos, end = writers[start], start, start + length
+        async for data in client.iter_download(
+            message.media, offset=start, limit=math.ceil(length / REQUEST_SIZE),
+            request_size=REQUEST_SIZE, file_size=file_size
+        ):
+            data = data[:end - pos]
+            await writer.write_async(data)
+            pos += len(data)
+            downloaded += len(data)
+            await _report(progress_callback, downloaded, file_size)
+            if checkpoint and downloaded - last_checkpoint >= checkpoint_step:
+                last_checkpoint = downloaded
+                checkpoint(await sink.sync())
+            if pos >= end:
+                break
+        if pos != end:
+            raise IOError(f'Short read for range {start}-{end}: got {pos - start} bytes')
+        await writer.finish_async()
+
+    try:
+        await _gather_or_cancel(fetch(start, length) for start, length in ranges)
+    finally:
+        await sink.close(file_size)
+    state.resumed_bytes += offset
+    return len(ranges)
+
+def use_parallel(message, file_size):
+    """Whether a message qualifies for the parallel large-file mode."""
+    return (
+        config.PARALLEL_DOWNLOAD_PARTS > 1
+        and message.document is not None
+        and file_size >= config.PARALLEL_DOWNLOAD_THRESHOLD_MB * 1024 * 1024
+    )
+
+async def download_message(client, message, path, file_size, progress_callback=None, offset=0, checkpoint=None, allocated=None):
+    """Download a message's media via a .part file, resuming documents from `offset`; returns the part count."""
+    part_path = part_path_for(path)
+    if message.document is not None and file_size > 0:
+        parts = config.PARALLEL_DOWNLOAD_PARTS if use_parallel(message, file_size) else 1
+        parts = await download_ranges(client, message, part_path, file_size, parts, offset, progress_callback, checkpoint, allocated)
+    else:
+        parts = 1
+        # Photos go through the same sink, sized from their largest thumbnail and trimmed to what arrived
+        sink = await DownloadSink.open(part_path, file_size)
+        writer = sink.writer(0)
+        try:
+            await client.download_media(message, writer, progress_callback=progress_callback)
+            writer.finish()
+        finally:
+            await sink.close(writer.pos)
+    os.replace(part_path, path)
+    return parts
+
+async def stream_message(client, message, remote_dir, file_name, file_size, progress_callback=None):
+    """Stream a document straight into the remote through a bounded in-memory buffer; returns bytes sent."""
+    if file_size and await uploader.remote_size(remote_dir, file_name) == file_size:
+        logger.info(f'{file_name} is already on the remote, skipping stream')
+        return 0
+    buffer = asyncio.Queue(maxsize=max(1, config.STREAM_BUFFER_MB * 1024 * 1024 // REQUEST_SIZE))
+    sent = 0
+
+    async def produce():
+        try:
+            async for data in client.iter_download(message.media, request_size=REQUEST_SIZE, file_size=file_size or None):
+                await buffer.put(data)
+            await buffer.put(None)
+        except Exception as e:
+            await buffer.put(e)
+
+    async def chunks():
+        nonlocal sent
+        while True:
+            data = await buffer.get()
+            if data is None:
+                break
+            if isinstance(data, Exception):
+                raise data
+            sent += len(data)
+            await _report(progress_callback, sent, file_size)
+            yield data
+        if file_size and sent != file_size:
+            raise IOError(f'Short stream: got {sent} of {file_size} bytes')
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        await uploader.rcat(remote_dir, file_name, file_size, chunks())
+    except BaseException:
+        # Some backends keep what was received before rclone was killed; timeouts and
+        # stall cancellations arrive as CancelledError and need the same cleanup
+        await uploader.delete_remote(remote_dir, file_name)
+        raise
+    finally:
+        producer.cancel()
+    if file_size:
+        remote = await uploader.remote_size(remote_dir, file_name)
+        if remote != file_size:
+            await uploader.delete_remote(remote_dir, file_name)
+            raise IOError(f'Remote size mismatch for {file_name}: {remote} != {file_size}')
+    state.streamed_bytes += sent
+    return sent
+
+def record_throughput(file_name, file_size, elapsed, parts, streamed=False):
+    """Keep per-file throughput samples for /stats."""
+    rate = file_size / elapsed if elapsed > 0 else 0
+    state.transfer_history.append({
+        'file_name': file_name, 'size': file_size, 'seconds': elapsed, 'parts': parts,
+        'streamed': streamed, 'rate': rate, 'finished': time.time()
+    })
+    return rate
+
+def _mode(sample):
+    if sample['streamed']:
+        return 'stream'
+    return 'parallel' if sample['parts'] > 1 else 'single'
+
+def throughput_summary():
+    """Average throughput of recent single-stream, parallel and streamed-to-remote downloads."""
+    summary = {}
+    for mode in ('single', 'parallel', 'stream'):
+        samples = [s for s in state.transfer_history if _mode(s) == mode]
+        total_bytes = sum(s['size'] for s in samples)
+        total_time = sum(s['seconds'] for s in samples)
+        summary[mode] = {'files': len(samples), 'rate': total_bytes / total_time if total_time > 0 else 0}
+    return summary
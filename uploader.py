@@ -0,0 +1,378 @@
+import os
+import json
+import time
+import asyncio
+import secrets
+import logging
+import tempfile
+import aiohttp
+import config
+import state
+import storage
+import dedup
+import retries
+
+logger = logging.getLogger('tg_downloader')
+
+# Long-lived `rclone rcd` daemon and its HTTP session
+_proc = None
+_session = None
+_base_url = None
+_semaphore = None
+_capacity = None  # set while the upload backlog is below its limits
+_batches = {}  # remote_dir -> (first_added, [upload items]) for small files awaiting a batch upload
+_upload_attempts = {}  # (channel_id, message_id) -> failed upload attempts so far
+_delayed = set()  # tasks putting failed uploads back on the queue after their backoff
+
+def remote_dir_for(dirname, datetime_dir_name):
+    """Remote directory for a channel/month folder."""
+    return f"{config.DRIVE_NAME}:{config.DRIVE_PATH}/{dirname}/{datetime_dir_name}"
+
+async def rc_call(command, **params):
+    """Call an rclone rc endpoint and return its JSON reply."""
+    async with _session.post(f'{_base_url}/{command}', json=params) as resp:
+        data = await resp.json(content_type=None)
+        if resp.status != 200:
+            raise RuntimeError(f"rclone rc {command} failed ({resp.status}): {data.get('error', data)}")
+        return data
+
+async def start():
+    """Start the rclone rc daemon; uploads fall back to one rclone process per file if it fails."""
+    global _proc, _session, _base_url, _semaphore
+    _semaphore = asyncio.Semaphore(max(1, config.UPLOAD_CONCURRENCY))
+    user, password = 'tgd', secrets.token_hex(16)
+    _base_url = f'http://{config.RCLONE_RC_ADDR}'
+    try:
+        _proc = await asyncio.create_subprocess_exec(
+            'rclone', 'rcd', '--rc-addr', config.RCLONE_RC_ADDR,
+            '--rc-user', user, '--rc-pass', password,
+            '--transfers', str(max(1, config.UPLOAD_CONCURRENCY)),
+            '--buffer-size', '16M', '--quiet'
+        )
+        _session = aiohttp.ClientSession(auth=aiohttp.BasicAuth(user, password))
+        deadline = time.time() + 15
+        while True:
+            try:
+                await rc_call('rc/noop')
+                break
+            except aiohttp.ClientError:
+                if _proc.returncode is not None or time.time() > deadline:
+                    raise
+                await asyncio.sleep(0.3)
+        logger.info(f'rclone rc daemon listening on {config.RCLONE_RC_ADDR}')
+    except Exception as e:
+        logger.error(f'Failed to start rclone rc daemon, using per-file rclone processes: {e}')
+        await stop()
+
+async def stop():
+    """Stop the rclone rc daemon."""
+    global _proc, _session
+    if _session:
+        try:
+            if _proc and _proc.returncode is None:
+                await rc_call('core/quit')
+        except Exception:
+            pass
+        await _session.close()
+        _session = None
+    if _proc and _proc.returncode is None:
+        try:
+            await asyncio.wait_for(_proc.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            _proc.kill()
+    _proc = None
+
+async def run_job(command, timeout, **params):
+    """Submit an async rc job and poll it until it finishes."""
+    job = await rc_call(command, _async=True, **params)
+    jobid = job['jobid']
+    deadline = time.time() + timeout
+    while True:
+        await asyncio.sleep(1)
+        status = await rc_call('job/status', jobid=jobid)
+        if status.get('finished'):
+            if not status.get('success'):
+                raise RuntimeError(status.get('error') or 'rclone job failed')
+            return status
+        if time.time() > deadline:
+            try: await rc_call('job/stop', jobid=jobid)
+            except Exception: pass
+            raise asyncio.TimeoutError(f'rclone job {jobid} timed out')
+
+async def _upload_subprocess(local_path, remote_dir):
+    args = [
+        'rclone', config.OPERATE, local_path, f'{remote_dir}/',
+        '--ignore-existing',
+        '--buffer-size', '16M',
+        '--quiet'
+    ]
+    proc = await asyncio.create_subprocess_exec(*args)
+    await asyncio.wait_for(proc.wait(), timeout=config.DOWNLOAD_TIMEOUT)
+    if proc.returncode != 0:
+        raise RuntimeError(f'rclone exited with code {proc.returncode}')
+
+async def upload_file(local_path, remote_dir):
+    """Upload one file to remote_dir with OPERATE (move/copy); the local copy is removed on success."""
+    async with _semaphore:
+        if _session is not None:
+            await run_job(
+                'operations/movefile' if config.OPERATE == 'move' else 'operations/copyfile',
+                config.DOWNLOAD_TIMEOUT,
+                srcFs=os.path.dirname(os.path.abspath(local_path)), srcRemote=os.path.basename(local_path),
+                dstFs=remote_dir, dstRemote=os.path.basename(local_path),
+                _config={'IgnoreExisting': True}
+            )
+        else:
+            await _upload_subprocess(local_path, remote_dir)
+    if config.OPERATE != 'move' and os.path.exists(local_path):
+        try: os.remove(local_path)
+        except: pass
+
+async def remote_size(remote_dir, file_name):
+    """Size of a remote file, or None if it does not exist."""
+    if _session is not None:
+        try:
+            item = (await rc_call('operations/stat', fs=remote_dir, remote=file_name)).get('item')
+        except RuntimeError:
+            item = None
+    else:
+        proc = await asyncio.create_subprocess_exec(
+            'rclone', 'lsjson', '--stat', f'{remote_dir}/{file_name}',
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        out, _ = await proc.communicate()
+        item = json.loads(out) if proc.returncode == 0 else None
+    return item['Size'] if item else None
+
+async def delete_remote(remote_dir, file_name):
+    """Best-effort removal of a remote file."""
+    try:
+        if _session is not None:
+            await rc_call('operations/deletefile', fs=remote_dir, remote=file_name)
+        else:
+            proc = await asyncio.create_subprocess_exec(
+                'rclone', 'deletefile', f'{remote_dir}/{file_name}', '--quiet',
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            await proc.wait()
+    except Exception as e:
+        logger.warning(f'Could not remove {remote_dir}/{file_name}: {e}')
+
+async def copy_remote(src_dir, src_name, dst_dir, dst_name):
+    """Copy a remote file to another remote path (server-side where the backend supports it)."""
+    async with _semaphore:
+        if _session is not None:
+            await run_job(
+                'operations/copyfile', config.DOWNLOAD_TIMEOUT,
+                srcFs=src_dir, srcRemote=src_name, dstFs=dst_dir, dstRemote=dst_name
+            )
+        else:
+            proc = await asyncio.create_subprocess_exec(
+                'rclone', 'copyto', f'{src_dir}/{src_name}', f'{dst_dir}/{dst_name}', '--quiet'
+            )
+            await asyncio.wait_for(proc.wait(), timeout=config.DOWNLOAD_TIMEOUT)
+            if proc.returncode != 0:
+                raise RuntimeError(f'rclone copyto exited with code {proc.returncode}')
+
+async def rcat(remote_dir, file_name, file_size, chunks):
+    """Pipe an async iterator of byte chunks into `rclone rcat`; the upload is aborted if the iterator fails."""
+    args = ['rclone', 'rcat', f'{remote_dir}/{file_name}', '--quiet']
+    if file_size:
+        args += ['--size', str(file_size)]
+    proc = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.PIPE)
+    try:
+        async for data in chunks:
+            proc.stdin.write(data)
+            await proc.stdin.drain()
+        proc.stdin.close()
+        await proc.wait()
+    except BaseException:
+        # Killing rclone instead of closing stdin keeps a truncated stream from being committed
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise RuntimeError(f'rclone rcat exited with code {proc.returncode}')
+
+def _update_capacity():
+    batched = sum(len(items) for _, items in _batches.values())
+    below_limits = (
+        state.upload_queue.qsize() + batched < config.UPLOAD_QUEUE_MAX_FILES
+        and state.upload_backlog_bytes < config.UPLOAD_QUEUE_MAX_MB * 1024 * 1024
+    )
+    if below_limits:
+        _capacity.set()
+    else:
+        _capacity.clear()
+
+async def wait_for_capacity():
+    """Block download workers while the upload backlog (files or bytes on disk) is over its limit."""
+    if _capacity is None or _capacity.is_set():
+        return
+    logger.info('Upload backlog full, pausing downloads')
+    await _capacity.wait()
+
+def _batchable(file_size):
+    return config.UPLOAD_BATCH_SIZE > 1 and file_size <= config.UPLOAD_BATCH_MAX_FILE_KB * 1024
+
+async def enqueue(channel_id, message_id, local_path, remote_dir, file_name, file_size):
+    """Hand a finished download to the upload stage; small files are grouped per remote directory."""
+    global _capacity
+    if _capacity is None:
+        _capacity = asyncio.Event()
+    state.upload_backlog_bytes += file_size
+    item = (channel_id, message_id, local_path, remote_dir, file_name, file_size)
+    if _batchable(file_size):
+        _, items = _batches.setdefault(remote_dir, (time.time(), []))
+        items.append(item)
+        if len(items) >= config.UPLOAD_BATCH_SIZE:
+            await _flush_batch(remote_dir)
+    else:
+        await state.upload_queue.put(item)
+    _update_capacity()
+
+async def _flush_batch(remote_dir):
+    _, items = _batches.pop(remote_dir)
+    await state.upload_queue.put(items)
+
+async def flush_batches():
+    """Ship every partial batch now, without waiting for UPLOAD_BATCH_WAIT."""
+    for remote_dir in list(_batches):
+        await _flush_batch(remote_dir)
+    _update_capacity()
+
+async def batch_flush_task():
+    """Ship partial batches once their oldest file has waited UPLOAD_BATCH_WAIT seconds."""
+    while True:
+        await asyncio.sleep(1)
+        try:
+            now = time.time()
+            for remote_dir, (first_added, _) in list(_batches.items()):
+                if now - first_added >= config.UPLOAD_BATCH_WAIT:
+                    await _flush_batch(remote_dir)
+            _update_capacity()
+        except Exception as e:
+            logger.error(f'Upload batch flush error: {e}')
+
+async def upload_batch(items):
+    """Upload files of one local directory to one remote directory in a single --files-from transfer.
+
+    Returns the items that were uploaded.
+    """
+    local_dir = os.path.dirname(os.path.abspath(items[0][2]))
+    remote_dir = items[0][3]
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8') as f:
+        f.write(''.join(f'{os.path.basename(item[2])}\n' for item in items))
+        files_from = f.name
+    error = None
+    try:
+        async with _semaphore:
+            if _session is not None:
+                await run_job(
+                    'sync/move' if config.OPERATE == 'move' else 'sync/copy',
+                    config.DOWNLOAD_TIMEOUT,
+                    srcFs=local_dir, dstFs=remote_dir,
+                    _filter={'FilesFrom': [files_from]},
+                    _config={'IgnoreExisting': True, 'Transfers': config.UPLOAD_BATCH_TRANSFERS}
+                )
+            else:
+                proc = await asyncio.create_subprocess_exec(
+                    'rclone', config.OPERATE, local_dir, f'{remote_dir}/',
+                    '--files-from', files_from,
+                    '--transfers', str(config.UPLOAD_BATCH_TRANSFERS),
+                    '--ignore-existing', '--quiet'
+                )
+                await asyncio.wait_for(proc.wait(), timeout=config.DOWNLOAD_TIMEOUT)
+                if proc.returncode != 0:
+                    raise RuntimeError(f'rclone exited with code {proc.returncode}')
+    except Exception as e:
+        error = e
+    finally:
+        os.remove(files_from)
+
+    if config.OPERATE == 'move':
+        # A moved file is gone locally; anything left behind did not make it
+        uploaded = [item for item in items if not os.path.exists(item[2])]
+    else:
+        uploaded = [] if error else items
+        for item in uploaded:
+            try: os.remove(item[2])
+            except: pass
+    if error:
+        logger.error(f'Batch upload to {remote_dir} failed for {len(items) - len(uploaded)}/{len(items)} files: {error}')
+    return uploaded
+
+async def _requeue_later(item, delay):
+    await asyncio.sleep(delay)
+    await state.upload_queue.put(item)
+
+async def _upload_failed(item, error):
+    """Requeue a failed upload after a backoff; the file's download retries are not touched.
+
+    After UPLOAD_MAX_RETRIES attempts the file is left on disk and in the queue journal,
+    so the next start uploads it again.
+    """
+    channel_id, message_id, _, _, file_name, file_size = item
+    key = (channel_id, message_id)
+    attempt = _upload_attempts.get(key, 0) + 1
+    if attempt >= config.UPLOAD_MAX_RETRIES:
+        _upload_attempts.pop(key, None)
+        state.upload_backlog_bytes -= file_size
+        logger.error(f'Upload of {file_name} failed {attempt} times, keeping it for the next start: {error}')
+        return
+    _upload_attempts[key] = attempt
+    delay = retries.backoff('upload', attempt)
+    logger.error(f'Upload error for {file_name}, retrying in {delay:.0f}s: {error}')
+    task = asyncio.create_task(_requeue_later(item, delay))
+    _delayed.add(task)
+    task.add_done_callback(_delayed.discard)
+
+def _upload_done(item, seconds):
+    channel_id, message_id, _, remote_dir, file_name, file_size = item
+    _upload_attempts.pop((channel_id, message_id), None)
+    state.upload_history.append({'size': file_size, 'seconds': seconds, 'finished': time.time()})
+    storage.record_file_complete(channel_id, message_id, 'completed', file_size=file_size)
+    dedup.upload_finished(channel_id, message_id, remote_dir, file_name)
+    state.upload_backlog_bytes -= file_size
+    state.queue.ack(channel_id, message_id)
+
+async def upload_worker(name):
+    """Upload stage worker: uploads finished downloads (single files or batches) and records their completion."""
+    while True:
+        item = await state.upload_queue.get()
+        batch = item if isinstance(item, list) else [item]
+        state.active_uploads += len(batch)
+        started = time.time()
+        try:
+            if isinstance(item, list):
+                uploaded = await upload_batch(batch)
+                seconds = (time.time() - started) / max(1, len(uploaded))
+                for done in uploaded:
+                    _upload_done(done, seconds)
+                for failed in batch:
+                    if failed not in uploaded:
+                        await _upload_failed(failed, 'not transferred in batch')
+                logger.info(f"[{name}] Batch upload completed: {len(uploaded)}/{len(batch)} files to {batch[0][3]}")
+            else:
+                await upload_file(item[2], item[3])
+                _upload_done(item, time.time() - started)
+                logger.info(f"[{name}] Upload completed: {item[4]}")
+        except Exception as e:
+            for failed in batch:
+                await _upload_failed(failed, e)
+        finally:
+            state.active_uploads -= len(batch)
+            state.upload_queue.task_done()
+            _update_capacity()
+
+def stage_stats():
+    """Queue depth, activity and recent throughput of the upload stage."""
+    samples = list(state.upload_history)
+    total_time = sum(s['seconds'] for s in samples)
+    return {
+        'queued': state.upload_queue.qsize() if state.upload_queue else 0,
+        'backlog_bytes': state.upload_backlog_bytes,
+        'active': state.active_uploads,
+        'rate': sum(s['size'] for s in samples) / total_time if total_time > 0 else 0
+    }
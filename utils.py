@@ -1,3 +1,4 @@
+import os
 import time
 import re
 import difflib
@@ -8,6 +9,13 @@ def validate_title(title):
     new_title = re.sub(r_str, "_", title)
     return new_title
 
+def bare_chat_id(chat_id):
+    """Chat id without its sign or -100 channel prefix, the form used by entity.id."""
+    id_str = str(chat_id)
+    if id_str.startswith('-100') and len(id_str) > 4:
+        return int(id_str[4:])
+    return abs(int(chat_id))
+
 def get_local_time():
     """Get current time formatted as YYYY-MM-DD HH:MM:SS."""
     return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
@@ -26,3 +34,12 @@ def bytes_to_string(byte_count):
     return '{:.2f}{}'.format(
         byte_count, [' bytes', 'KB', 'MB', 'GB', 'TB'][suffix_index]
     )
+
+def get_rss():
+    """Resident memory of this process in bytes (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024